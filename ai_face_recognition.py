@@ -1,10 +1,69 @@
 import cv2
+import hashlib
+import multiprocessing
 import numpy as np
 import os
 import pickle
 import sqlite3
+import time
 from pathlib import Path
 from insightface.app import FaceAnalysis
+from insightface.utils import face_align
+from face_gallery import FaceGallery, normalize_rows, spherical_kmeans
+from database import (get_face_encoding_cache, load_face_encodings, save_user_face_encodings,
+                      save_student_face_encodings, get_student_owner, get_gallery_version,
+                      bump_gallery_version)
+
+# Per-image embeddings kept per student; larger sets are clustered down to this many prototypes
+MAX_PROTOTYPES = 8
+MODEL_NAME = 'buffalo_s'
+# Aligned face crops sent through the recognition ONNX session per run
+EMBED_BATCH_SIZE = 32
+# Processes used by train_user_model (1 = train in this process)
+TRAIN_WORKERS = int(os.environ.get('TRAIN_WORKERS', '1'))
+# Seconds between checks whether another process changed a cached gallery
+GALLERY_CHECK_SECONDS = 5.0
+# Live-stream pre-filter (recognize_faces with stream=...): frames are compared at this width
+PREFILTER_WIDTH = 96
+# Mean gray level change (0-255) below which a frame counts as unchanged
+PREFILTER_UNCHANGED_DELTA = 2.0
+# Results of an unchanged scene are reused for at most this many seconds
+PREFILTER_MAX_AGE = 60.0
+# An empty scene is trusted for at most this long, then a full pass looks again
+# (the low-resolution pass can miss small, distant faces)
+PREFILTER_NO_FACE_MAX_AGE = 5.0
+# Detection profile of the cheap "is any face present" pass
+PREFILTER_PROFILE = 'verify'
+# Detector input size per use: small for single-face verification snapshots,
+# medium for live video, large for group photos and training images
+DETECTION_PROFILES = {
+    'verify': (320, 320),
+    'live': (480, 480),
+    'group': (640, 640),
+    'train': (640, 640),
+}
+DEFAULT_PROFILE = 'group'
+
+# Model instance owned by a training worker process
+worker_recognizer = None
+
+
+def init_training_worker():
+    """Pool initializer: load a private, single-threaded model in this worker"""
+    global worker_recognizer
+    import onnxruntime
+    cv2.setNumThreads(1)
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = 1
+    options.inter_op_num_threads = 1
+    worker_recognizer = AIFaceRecognition(sess_options=options)
+
+
+def embed_student_images(task):
+    """Pool task: embed one student's new images with the worker's own model"""
+    s_id, paths = task
+    return s_id, worker_recognizer.embed_image_files(paths)
+
 
 class AIFaceRecognition:
     """
@@ -12,44 +71,324 @@ class AIFaceRecognition:
     Uses 'buffalo_s' model (lightweight, ~512MB RAM usage).
     """
     
-    def __init__(self):
+    def __init__(self, sess_options=None):
         # Initialize InsightFace
         # allowed_modules=['detection', 'recognition'] to save memory
-        self.app = FaceAnalysis(name='buffalo_s', allowed_modules=['detection', 'recognition'])
+        self.app = FaceAnalysis(name=MODEL_NAME, allowed_modules=['detection', 'recognition'])
+        # onnxruntime.SessionOptions for every model session (None = onnxruntime defaults)
+        self.sess_options = sess_options
+        det_size = DETECTION_PROFILES[DEFAULT_PROFILE]
         # Prepare using CPU (ctx_id=0 for GPU, -1 for CPU, but InsightFace usually auto-detects)
         # On Render Free Tier/Standard Cloud, usually CPU.
         try:
-            self.app.prepare(ctx_id=0, det_size=(640, 640))
+            self.ctx_id = 0
+            self.app.prepare(ctx_id=self.ctx_id, det_size=det_size)
             print("[OK] InsightFace 'buffalo_s' loaded on GPU/CPU")
         except:
-            self.app.prepare(ctx_id=-1, det_size=(640, 640))
+            self.ctx_id = -1
+            self.app.prepare(ctx_id=self.ctx_id, det_size=det_size)
             print("[OK] InsightFace 'buffalo_s' loaded on CPU")
+
+        # Detection and recognition are driven separately so crops can be embedded in batches
+        self.det_model = self.app.det_model
+        self.rec_model = self.app.models['recognition']
+        for model in (self.det_model, self.rec_model):
+            self.apply_session_options(model)
+        # {input size: prepared detector session}; profiles of the same size share one,
+        # all profiles share rec_model
+        self.detectors = {det_size: self.det_model}
             
         # Cache: {user_id: {student_id: [embedding_vector]}}
         self.active_embeddings = {}
+        # Cache: {user_id: FaceGallery} - same data as one float32 matrix for matching
+        self.active_galleries = {}
+        # {user_id: (gallery version the caches reflect, last check time)}
+        self.gallery_versions = {}
+        # {stream: pre-filter state of a live stream}, see prefilter()
+        self.stream_states = {}
         
+    def apply_session_options(self, model):
+        """
+        Rebuild a prepared model's ONNX session with self.sess_options, keeping
+        its providers (insightface's get_model does not pass session options on).
+        """
+        if self.sess_options is None:
+            return
+        import onnxruntime
+        model.session = onnxruntime.InferenceSession(model.model_file, sess_options=self.sess_options,
+                                                     providers=model.session.get_providers())
+
     def get_user_embeddings(self, user_id):
-        """Load embeddings for a specific user"""
+        """Load embeddings for a specific user (face_encodings table, legacy pickle as fallback)"""
         if user_id in self.active_embeddings:
             return self.active_embeddings[user_id]
-            
+
+        try:
+            matrix, student_ids, names = load_face_encodings(user_id, MODEL_NAME)
+        except Exception as e:
+            print(f"[ERROR] Error loading embeddings: {e}")
+            return {}
+
+        if student_ids:
+            embeddings = self.entries_from_rows(matrix, student_ids, names)
+            self.active_embeddings[user_id] = embeddings
+            print(f"[OK] Loaded {len(embeddings)} students for User {user_id}")
+            return embeddings
+
         emb_path = f'models/embeddings_{user_id}.pkl'
         if os.path.exists(emb_path):
             try:
                 with open(emb_path, 'rb') as f:
                     embeddings = pickle.load(f)
                 self.active_embeddings[user_id] = embeddings
-                print(f"[OK] Loaded {len(embeddings)} students for User {user_id}")
+                print(f"[OK] Loaded {len(embeddings)} students for User {user_id} (legacy pickle)")
                 return embeddings
             except Exception as e:
                 print(f"[ERROR] Error loading embeddings: {e}")
                 return {}
         return {}
+
+    def get_user_gallery(self, user_id):
+        """Get (or build) the contiguous matching gallery for a user"""
+        if user_id in self.active_galleries:
+            if not self.gallery_changed(user_id):
+                return self.active_galleries[user_id]
+            # Retrained or edited in another process
+            self.active_embeddings.pop(user_id, None)
+            self.active_galleries.pop(user_id, None)
+
+        version = get_gallery_version(user_id)
+        embeddings = self.get_user_embeddings(user_id)
+        if not embeddings:
+            return None
+
+        gallery = FaceGallery.from_embeddings(embeddings)
+        gallery.load_index(f'models/ann_{user_id}.npz')
+        self.active_galleries[user_id] = gallery
+        self.gallery_versions[user_id] = (version, time.monotonic())
+        return gallery
+
+    def gallery_changed(self, user_id):
+        """True if the stored gallery version moved past the cached one (checked every few seconds)"""
+        version, checked_at = self.gallery_versions.get(user_id, (None, 0.0))
+        now = time.monotonic()
+        if now - checked_at < GALLERY_CHECK_SECONDS:
+            return False
+        try:
+            current = get_gallery_version(user_id)
+        except Exception as e:
+            print(f"[WARN] Could not check gallery version: {e}")
+            return False
+        self.gallery_versions[user_id] = (version, now)
+        return current != version
+
+    def set_user_embeddings(self, user_id, embeddings, version):
+        """Install a user's embeddings as the cached gallery; large rosters get an ANN index saved"""
+        gallery = FaceGallery.from_embeddings(embeddings)
+        ann_path = f'models/ann_{user_id}.npz'
+        if gallery.build_index() is not None:
+            os.makedirs('models', exist_ok=True)
+            gallery.index.save(ann_path)
+        elif os.path.exists(ann_path):
+            os.remove(ann_path)
+
+        self.active_embeddings[user_id] = embeddings
+        self.active_galleries[user_id] = gallery
+        self.gallery_versions[user_id] = (version, time.monotonic())
+        return gallery
+
+    def entries_from_rows(self, matrix, student_ids, names):
+        """Per-student gallery entries from load_face_encodings rows (grouped by student)"""
+        embeddings = {}
+        start = 0
+        for end in range(1, len(student_ids) + 1):
+            if end == len(student_ids) or student_ids[end] != student_ids[start]:
+                embeddings[student_ids[start]] = self.build_student_entry(names[start], matrix[start:end])
+                start = end
+        return embeddings
+
+    def find_student_folder(self, student_images_dir, s_id, s_name):
+        """Image folder of a student ({id}_{name}, or the legacy {name}), or None"""
+        from werkzeug.utils import secure_filename
+        secure_name = secure_filename(s_name.lower().replace(' ', '_'))
+        path = os.path.join(student_images_dir, f"{s_id}_{secure_name}")
+        if os.path.exists(path):
+            return path
+        # Legacy check
+        path = os.path.join(student_images_dir, secure_name)
+        if os.path.exists(path):
+            return path
+        return None
+
+    def sync_student(self, student_id, previous_user_id=None):
+        """
+        Bring cached galleries in line with one student's current DB state
+        without retraining: a deleted student's rows are dropped, a moved or
+        renamed student only has its metadata updated, and newly stored
+        embeddings are picked up. previous_user_id is the owner before a move.
+        Returns True (the change was applied).
+        """
+        owner = get_student_owner(student_id)
+        user_ids = {previous_user_id} - {None}
+        if owner:
+            user_ids.add(owner[0])
+
+        for user_id in user_ids:
+            embeddings = dict(self.get_user_embeddings(user_id))
+            embeddings.pop(student_id, None)
+            if owner and owner[0] == user_id and owner[2]:
+                matrix, student_ids, names = load_face_encodings(user_id, MODEL_NAME, student_id)
+                embeddings.update(self.entries_from_rows(matrix, student_ids, names))
+            self.set_user_embeddings(user_id, embeddings, bump_gallery_version(user_id))
+        return True
+
+    def add_student_images(self, student_id, student_images_dir='static/student_images'):
+        """
+        Embed a student's new images and add them to the gallery without a full retrain.
+        Images already stored (same content hash) are not embedded again.
+        """
+        owner = get_student_owner(student_id)
+        if not owner:
+            return False, "Student not found."
+        user_id, s_name, _ = owner
+
+        old_cache = get_face_encoding_cache(user_id, MODEL_NAME)
+        if not old_cache and os.path.exists(f'models/embeddings_{user_id}.pkl'):
+            # The rest of this user's gallery only exists in the legacy pickle
+            return False, "Please train the system once to migrate stored faces."
+
+        path = self.find_student_folder(student_images_dir, student_id, s_name)
+        if not path:
+            return False, "No images found."
+
+        records, new_images = [], []
+        for img_path in self.student_image_files(path):
+            key = self.image_hash(img_path.read_bytes())
+            if key in old_cache:
+                records.append((student_id, key, str(img_path), old_cache[key]))
+            else:
+                new_images.append((key, str(img_path)))
+
+        for i, vector in self.embed_image_files([p for _, p in new_images]):
+            key, img_path = new_images[i]
+            records.append((student_id, key, img_path, vector))
+
+        save_student_face_encodings(student_id, MODEL_NAME, records)
+        self.sync_student(student_id)
+        found = sum(1 for r in records if r[3] is not None)
+        print(f"  [OK] Added {s_name}: {found} samples ({len(new_images)} embedded)")
+        return found > 0, f"{found} face samples added."
+
+    def student_image_files(self, path):
+        """Enrollment images (jpg/png) in a student folder"""
+        return [p for p in Path(path).glob('*.*') if p.suffix.lower() in ['.jpg', '.jpeg', '.png']]
+
+    def image_hash(self, data):
+        """Content hash of raw image bytes; a changed file gets a new embedding"""
+        return hashlib.sha1(data).hexdigest()
+
+    def get_detector(self, profile=None):
+        """Detector session prepared for a DETECTION_PROFILES entry (created on first use)"""
+        size = DETECTION_PROFILES.get(profile or DEFAULT_PROFILE, DETECTION_PROFILES[DEFAULT_PROFILE])
+        if size not in self.detectors:
+            from insightface.model_zoo import get_model
+            detector = get_model(self.det_model.model_file)
+            detector.prepare(self.ctx_id, input_size=size, det_thresh=self.det_model.det_thresh)
+            self.apply_session_options(detector)
+            self.detectors[size] = detector
+            print(f"[OK] Detector prepared for '{profile}' profile at {size[0]}x{size[1]}")
+        return self.detectors[size]
+
+    def detect_faces(self, img, profile=None):
+        """Face boxes (x1, y1, x2, y2, score) and 5-point landmarks, without embedding"""
+        bboxes, kpss = self.get_detector(profile).detect(img, max_num=0, metric='default')
+        if kpss is None:
+            return np.zeros((0, 5), dtype=np.float32), np.zeros((0, 5, 2), dtype=np.float32)
+        return bboxes, kpss
+
+    def align_faces(self, img, kpss):
+        """112x112 ArcFace-aligned crops for the given landmarks"""
+        size = self.rec_model.input_size[0]
+        return [face_align.norm_crop(img, landmark=kps, image_size=size) for kps in kpss]
+
+    def embed_crops(self, crops):
+        """Unit-length embeddings of aligned crops, EMBED_BATCH_SIZE crops per ONNX run"""
+        if not crops:
+            return np.zeros((0, 0), dtype=np.float32)
+        feats = [self.rec_model.get_feat(crops[i:i + EMBED_BATCH_SIZE])
+                 for i in range(0, len(crops), EMBED_BATCH_SIZE)]
+        return normalize_rows(np.concatenate(feats))
+
+    def largest_face_crop(self, img):
+        """Aligned crop of the largest face in an enrollment image, or None"""
+        bboxes, kpss = self.detect_faces(img, profile='train')
+        if len(bboxes) == 0:
+            return None
+        areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+        return self.align_faces(img, kpss[[int(np.argmax(areas))]])[0]
+
+    def embed_image_files(self, paths, on_image=None):
+        """
+        Largest-face embedding of every readable image in `paths`.
+        Returns [(position in paths, vector or None)]; unreadable images are left out.
+        Crops are collected across images and embedded EMBED_BATCH_SIZE at a time.
+        on_image(position) is called once each image has been handled.
+        """
+        results = []
+        crop_slots, crops = [], []
+
+        def flush():
+            for slot, vector in zip(crop_slots, self.embed_crops(crops)):
+                results[slot] = (results[slot][0], vector)
+            crop_slots.clear()
+            crops.clear()
+
+        for i, img_path in enumerate(paths):
+            try:
+                img = cv2.imread(str(img_path))
+                if img is None: continue
+
+                crop = self.largest_face_crop(img)
+                results.append((i, None))
+                if crop is not None:
+                    crop_slots.append(len(results) - 1)
+                    crops.append(crop)
+            except Exception as e:
+                print(f"Skip {Path(img_path).name}: {e}")
+            if on_image:
+                on_image(i)
+
+            # Outside the per-image try: a failed batch must not be stored as 'no face'
+            if len(crops) >= EMBED_BATCH_SIZE:
+                flush()
+
+        flush()
+        return results
+
+    def build_student_entry(self, name, vectors):
+        """Gallery entry for one student from its per-image embeddings"""
+        samples = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        prototypes = samples
+        if len(samples) > MAX_PROTOTYPES:
+            prototypes, _ = spherical_kmeans(samples, MAX_PROTOTYPES)
+
+        # Mean vector kept for older readers of the pickle
+        mean_vector = normalize_rows(samples.mean(axis=0, keepdims=True))[0]
+        return {
+            'name': name,
+            'vectors': prototypes,
+            'vector': mean_vector,
+            'count': len(vectors)
+        }
         
-    def train_user_model(self, user_id, student_images_dir='static/student_images'):
+    def train_user_model(self, user_id, student_images_dir='static/student_images', workers=None, progress=None):
         """
         'Train' by extracting face embeddings from images.
-        We average multiple images of a student to create a robust 'prototype' vector.
+        Every image's embedding is kept (clustered into at most MAX_PROTOTYPES
+        prototypes per student) so recognition can vote over them.
+        With workers > 1 (default TRAIN_WORKERS) new images are embedded
+        in a process pool, one student folder per task.
+        progress(student_id, name, done, total) is called as each student's images are handled.
         """
         print(f"🎓 Starting AI Analysis for User {user_id}")
         
@@ -70,77 +409,168 @@ class AIFaceRecognition:
              
         if not students:
              self.active_embeddings.pop(user_id, None)
+             self.active_galleries.pop(user_id, None)
              return False, "No active students found."
              
-        student_embeddings = {} # {student_id: {'name': name, 'vector': np.array}}
+        student_embeddings = {} # {student_id: {'name': name, 'vectors': np.array, 'vector': np.array}}
+
+        # Only images that are new or changed since the last run get embedded
+        try:
+            old_cache = get_face_encoding_cache(user_id, MODEL_NAME)
+        except Exception as e:
+            print(f"[WARN] Ignoring stored embeddings: {e}")
+            old_cache = {}
+        records = [] # (student_id, content_hash, image_path, vector or None)
+        new_images = {} # {student_id: [(content_hash, image_path)]} still to be embedded
+        names = {}
         
         for s_id, s_name in students:
-            # Find folder
-            from werkzeug.utils import secure_filename
-            secure_name = secure_filename(s_name.lower().replace(' ', '_'))
-            folder_new = f"{s_id}_{secure_name}"
-            
-            # Simple path check
-            path = os.path.join(student_images_dir, folder_new)
-            if not os.path.exists(path):
-                # Legacy check
-                path = os.path.join(student_images_dir, secure_name)
-                if not os.path.exists(path):
-                    continue
-            
-            # Process images
-            vectors = []
-            image_files = list(Path(path).glob('*.*'))
+            path = self.find_student_folder(student_images_dir, s_id, s_name)
+            if not path:
+                continue
             
-            for img_path in image_files:
-                if img_path.suffix.lower() not in ['.jpg', '.jpeg', '.png']: continue
-                
+            names[s_id] = s_name
+            for img_path in self.student_image_files(path):
                 try:
-                    img = cv2.imread(str(img_path))
-                    if img is None: continue
-                    
-                    # InsightFace detection
-                    faces = self.app.get(img)
-                    
-                    if len(faces) > 0:
-                        # Take the largest face
-                        face = max(faces, key=lambda x: (x.bbox[2]-x.bbox[0]) * (x.bbox[3]-x.bbox[1]))
-                        # Normalize vector
-                        embedding = face.embedding
-                        vectors.append(embedding)
+                    key = self.image_hash(img_path.read_bytes())
                 except Exception as e:
                     print(f"Skip {img_path.name}: {e}")
-                    
-            if vectors:
-                # Average vectors for stable ID
-                mean_vector = np.mean(vectors, axis=0)
-                # Normalize again (important for cosine similarity)
-                from numpy.linalg import norm
-                mean_vector = mean_vector / norm(mean_vector)
-                
-                student_embeddings[s_id] = {
-                    'name': s_name,
-                    'vector': mean_vector,
-                    'count': len(vectors)
-                }
-                print(f"  [OK] Processed {s_name}: {len(vectors)} samples")
-                
+                    continue
+
+                if key in old_cache:
+                    # Stored result (None = no face was found in this image)
+                    records.append((s_id, key, str(img_path), old_cache[key]))
+                else:
+                    new_images.setdefault(s_id, []).append((key, str(img_path)))
+
+        cache_hits = len(records)
+        totals = {}
+        done = {s_id: 0 for s_id in names}
+        for s_id, _, _, _ in records:
+            done[s_id] += 1
+        for s_id in names:
+            totals[s_id] = done[s_id] + len(new_images.get(s_id, []))
+            if progress:
+                progress(s_id, names[s_id], done[s_id], totals[s_id])
+
+        tasks = [(s_id, [p for _, p in items]) for s_id, items in new_images.items()]
+        if workers is None:
+            workers = TRAIN_WORKERS
+        workers = min(workers, len(tasks))
+
+        if workers > 1:
+            # One student folder per task; every worker process loads its own model
+            print(f"  [INFO] Embedding {len(tasks)} students on {workers} processes")
+            # Spawned, not forked: the server process runs camera, training and ONNX threads
+            # whose locks a forked child could inherit held
+            with multiprocessing.get_context('spawn').Pool(workers, initializer=init_training_worker) as pool:
+                for s_id, embedded in pool.imap_unordered(embed_student_images, tasks):
+                    items = new_images[s_id]
+                    for i, vector in embedded:
+                        key, img_path = items[i]
+                        records.append((s_id, key, img_path, vector))
+                    if progress:
+                        progress(s_id, names[s_id], totals[s_id], totals[s_id])
+        else:
+            # All new images in one pass so embedding batches span students
+            items = [(s_id, key, img_path) for s_id, entries in new_images.items() for key, img_path in entries]
+
+            def on_image(i):
+                s_id = items[i][0]
+                done[s_id] += 1
+                if progress:
+                    progress(s_id, names[s_id], done[s_id], totals[s_id])
+
+            for i, vector in self.embed_image_files([img_path for _, _, img_path in items], on_image):
+                records.append(items[i] + (vector,))
+
+        student_vectors = {}
+        for s_id, _, _, vector in records:
+            if vector is not None:
+                student_vectors.setdefault(s_id, []).append(vector)
+        for s_id, vectors in student_vectors.items():
+            student_embeddings[s_id] = self.build_student_entry(names[s_id], vectors)
+            print(f"  [OK] Processed {names[s_id]}: {len(vectors)} samples")
+
+        print(f"  [OK] {cache_hits} images reused from database, {len(records) - cache_hits} embedded")
+
         # Save
         if not student_embeddings:
             return False, "No faces found in student images."
             
         os.makedirs('models', exist_ok=True)
         try:
-            with open(f'models/embeddings_{user_id}.pkl', 'wb') as f:
-                pickle.dump(student_embeddings, f)
-            self.active_embeddings[user_id] = student_embeddings
+            # Replaces the trained students' rows in one transaction; deleted/replaced images drop out here
+            save_user_face_encodings(user_id, MODEL_NAME, records, [s_id for s_id, _ in students])
+
+            # Superseded by the face_encodings table
+            if os.path.exists(f'models/embeddings_{user_id}.pkl'):
+                os.remove(f'models/embeddings_{user_id}.pkl')
+
+            # Other processes reload on their next version check
+            self.set_user_embeddings(user_id, student_embeddings, bump_gallery_version(user_id))
             return True, "Analysis Complete! System updated."
         except Exception as e:
             return False, f"Save Error: {e}"
 
-    def recognize_faces(self, frame, user_id, confidence_threshold=0.5): # 0.5 is good for ArcFace cosine
+    def prefilter(self, frame, stream, gallery):
+        """
+        Cheap checks before full detection, for frames of a live stream:
+        an unchanged frame (compared at PREFILTER_WIDTH with the last analysed one)
+        gets that frame's results again, and a frame where a low-resolution
+        detector pass finds no face gets []. The low-resolution pass is only
+        trusted while the last full pass found no face either, and for at most
+        PREFILTER_NO_FACE_MAX_AGE. Returns None if the full pass must run.
+        """
+        state = self.stream_states.setdefault(stream, {
+            'frame': None, 'results': [], 'gallery': None, 'time': 0.0,
+            'faces_seen': False, 'full_time': 0.0,
+            'stats': {'frames': 0, 'skipped_unchanged': 0, 'skipped_no_face': 0, 'analysed': 0},
+        })
+        stats = state['stats']
+        stats['frames'] += 1
+
+        height, width = frame.shape[:2]
+        small = cv2.resize(frame, (PREFILTER_WIDTH, max(1, height * PREFILTER_WIDTH // width)),
+                           interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (3, 3), 0)
+        now = time.monotonic()
+        max_age = PREFILTER_MAX_AGE if state['results'] else PREFILTER_NO_FACE_MAX_AGE
+        if (state['frame'] is not None and state['frame'].shape == small.shape
+                and state['gallery'] is gallery and now - state['time'] < max_age
+                and cv2.absdiff(small, state['frame']).mean() < PREFILTER_UNCHANGED_DELTA):
+            stats['skipped_unchanged'] += 1
+            return [dict(res) for res in state['results']]
+
+        state.update(frame=small, gallery=gallery, time=now, results=[])
+        if not state['faces_seen'] and now - state['full_time'] < PREFILTER_NO_FACE_MAX_AGE:
+            bboxes, _ = self.detect_faces(frame, profile=PREFILTER_PROFILE)
+            if len(bboxes) == 0:
+                stats['skipped_no_face'] += 1
+                return []
+        stats['analysed'] += 1
+        return None
+
+    def remember_stream_results(self, stream, profile, results):
+        """Record a full pass's results (and detection profile) for the stream's pre-filter; returns results"""
+        if stream is not None:
+            state = self.stream_states[stream]
+            state.update(results=[dict(res) for res in results], faces_seen=bool(results), full_time=time.monotonic())
+            state['stats']['profile'] = profile
+        return results
+
+    def prefilter_stats(self, stream):
+        """Frames of a live stream seen by the pre-filter, how many skipped the full pass and its profile"""
+        state = self.stream_states.get(stream)
+        return dict(state['stats']) if state else {}
+
+    def recognize_faces(self, frame, user_id, confidence_threshold=0.5, stream=None, profile=None): # 0.5 is good for ArcFace cosine
         """
-        Recognize faces using Cosine Similarity
+        Recognize faces using Cosine Similarity.
+        With stream (any key naming a live video source) frames first go through
+        the pre-filter, which skips detection and embedding for unchanged or faceless frames.
+        profile picks the detector input size (DETECTION_PROFILES); default 'live'
+        for streams, DEFAULT_PROFILE otherwise.
         """
         # Handle Legacy/OpenCV threshold values (e.g. 100)
         # Cosine similarity is 0.0 to 1.0. If we get > 1, it's likely a mistake from shared code.
@@ -148,34 +578,33 @@ class AIFaceRecognition:
             confidence_threshold = 0.5
 
         threshold = confidence_threshold
-        embeddings = self.get_user_embeddings(user_id)
-        if not embeddings:
+        gallery = self.get_user_gallery(user_id)
+        if not gallery:
             return []
+
+        if stream is not None:
+            results = self.prefilter(frame, stream, gallery)
+            if results is not None:
+                return results
             
-        # Detect faces in current frame
-        faces = self.app.get(frame)
+        # Detect faces in current frame, then embed all of them in batched ONNX runs
+        if profile is None:
+            profile = 'live' if stream is not None else DEFAULT_PROFILE
+        bboxes, kpss = self.detect_faces(frame, profile=profile)
+        if len(bboxes) == 0:
+            return self.remember_stream_results(stream, profile, [])
+        embeddings = self.embed_crops(self.align_faces(frame, kpss))
+
+        # Score every face against every prototype in one matrix multiply and
+        # let the top-k prototypes vote. Embeddings are unit length, so the
+        # dot product is cosine similarity.
+        best_rows, best_scores = gallery.match(embeddings, min_score=threshold)
+
         results = []
-        
-        for face in faces:
+        for bbox, row, best_score in zip(bboxes, best_rows, best_scores):
             # Bounding box
-            bbox = face.bbox.astype(int)
-            vector = face.embedding
-             
-            # Compare with all students
-            best_score = -1.0
-            best_match = None
-            
-            for s_id, data in embeddings.items():
-                target_vector = data['vector']
-                
-                # Cosine Similarity: dot(A, B) / (norm(A)*norm(B))
-                # Vectors from InsightFace are usually normalized, so just dot product
-                score = np.dot(vector, target_vector)
-                
-                if score > best_score:
-                    best_score = score
-                    best_match = data
-                    best_id = s_id
+            bbox = bbox[:4].astype(int)
+            best_score = float(best_score)
             
             # Determine match
             res = {
@@ -185,13 +614,13 @@ class AIFaceRecognition:
                 'confidence': 0.0
             }
             
-            if best_score > threshold and best_match:
-                res['name'] = best_match['name']
-                res['student_id'] = best_id
+            if best_score > threshold:
+                res['name'] = gallery.names[row]
+                res['student_id'] = int(gallery.student_ids[row])
                 res['confidence'] = int(best_score * 100)
             
             # Optional: Return 'raw_confidence' for debugging
             res['raw_confidence'] = best_score
             results.append(res)
-            
-        return results
+
+        return self.remember_stream_results(stream, profile, results)
@@ -206,9 +206,6 @@ else:
              print(f"[ERROR] Fallback failed: {e2}")
              face_recognizer = None
 
-# Global camera variable
-camera = None
-
 @app.route('/get_latest_attendance')
 def get_latest_attendance():
     """Get latest attendance for AJAX update"""
@@ -449,13 +446,56 @@ def add_student():
                 file.save(file_path)
                 image_count += 1
             
-            flash(f'Student {name} added successfully with {image_count} images! Please train the system.', 'success')
+            gallery_update = update_face_gallery(student_id, new_images=True)
+            if gallery_update == 'updated':
+                flash(f'Student {name} added successfully with {image_count} images and is ready for recognition!', 'success')
+            elif gallery_update == 'queued':
+                flash(f'Student {name} added successfully with {image_count} images! Recognition will include them once the queued training run finishes.', 'success')
+            else:
+                flash(f'Student {name} added successfully with {image_count} images! Please train the system.', 'success')
             return redirect(url_for('students'))
         else:
             flash('Error adding student. Roll number might already exist.', 'error')
     
     return render_template('add_student.html', classes=classes)
 
+def update_face_gallery(student_id, previous_user_id=None, new_images=False):
+    """
+    Apply one student's change to the face gallery without a full retrain.
+    Returns 'updated', 'queued' when a background training run was queued to
+    pick the change up instead (a run is in progress, or the incremental update
+    could not be applied), or None if the recognizer supports neither.
+    """
+    if not face_recognizer or not hasattr(face_recognizer, 'add_student_images' if new_images else 'sync_student'):
+        return None
+    from database import get_student_owner
+    from training_jobs import acquire_user_lock, release_user_lock, submit_training
+    owner = get_student_owner(student_id)
+    user_ids = sorted({previous_user_id, owner[0] if owner else None} - {None})
+    # Never wait for a running training here (it can take longer than the request timeout);
+    # its result would overwrite this change, so a follow-up run is queued instead
+    locks = [acquire_user_lock(user_id) for user_id in user_ids]
+    applied = False
+    try:
+        if None in locks:
+            print(f"[INFO] Training in progress, queuing a follow-up run for student {student_id}")
+        elif new_images:
+            applied, message = face_recognizer.add_student_images(student_id, STUDENT_IMAGES)
+        else:
+            applied = face_recognizer.sync_student(student_id, previous_user_id)
+    except Exception as e:
+        print(f"[WARN] Gallery update failed for student {student_id}: {e}")
+    finally:
+        for lock_file in locks:
+            if lock_file is not None:
+                release_user_lock(lock_file)
+
+    if applied:
+        return 'updated'
+    for user_id in user_ids:
+        submit_training(face_recognizer, user_id, STUDENT_IMAGES)
+    return 'queued' if user_ids else None
+
 @app.route('/students/bulk_upload', methods=['POST'])
 @login_required
 def bulk_upload_students():
@@ -539,7 +579,15 @@ def bulk_upload_students():
     flash(f'Imported {count} students successfully. {errors} failed.', 'success' if count > 0 else 'warning')
     
     if count > 0:
-        flash('Please train the system now to recognize the new faces.', 'info')
+        # Only the new images get embedded; existing students are reused from the database
+        try:
+            if face_recognizer:
+                from training_jobs import submit_training
+                submit_training(face_recognizer, current_user.id, STUDENT_IMAGES)
+                flash('The new faces are being added in the background. Progress is shown below.', 'info')
+        except Exception as e:
+            print(f"[WARN] Could not queue training: {e}")
+            flash('Please train the system now to recognize the new faces.', 'info')
         
     return redirect(url_for('students', class_id=class_id))
 
@@ -561,10 +609,14 @@ def edit_student(student_id):
         phone = request.form.get('phone', '').strip()
         class_id = request.form.get('class_id', type=int)
         
-        from database import update_student
+        from database import update_student, get_student_owner
+        previous_owner = get_student_owner(student_id)
         update_student(student_id, name, roll_number, email, phone, class_id)
-        
-        flash('Student updated successfully!', 'success')
+        # Name/class changes only touch gallery metadata; faces are not re-embedded
+        if update_face_gallery(student_id, previous_user_id=previous_owner[0] if previous_owner else None) == 'queued':
+            flash('Student updated successfully! The change will be included by the queued training run.', 'success')
+        else:
+            flash('Student updated successfully!', 'success')
         conn.close()
         return redirect(url_for('students'))
     
@@ -610,14 +662,14 @@ def delete_student(student_id):
         flash(f'Error deleting student: {e}', 'error')
         return redirect(url_for('students'))
     
-    # Retrain system to update model immediately
-    # try:
-    #     if face_recognizer:
-    #         face_recognizer.train_from_images()
-    # except:
-    #     pass
-        
-    flash('Student deleted successfully! Please retrain the system.', 'success')
+    # Drop the student's faces from the gallery immediately (no retrain needed)
+    gallery_update = update_face_gallery(student_id)
+    if gallery_update == 'updated':
+        flash('Student deleted successfully!', 'success')
+    elif gallery_update == 'queued':
+        flash('Student deleted successfully! The queued training run will remove their faces.', 'success')
+    else:
+        flash('Student deleted successfully! Please retrain the system.', 'success')
     return redirect(url_for('students'))
 
 # ============================================================================
@@ -876,7 +928,9 @@ def verify_face():
         
         if face_recognizer:
             # We use a strict threshold for single-snap verification
-            faces = face_recognizer.recognize_faces(frame, current_user.id, confidence_threshold=100)
+            # AI mode: small, fast detector profile for a single close-up face
+            kwargs = {'profile': 'verify'} if hasattr(face_recognizer, 'get_detector') else {}
+            faces = face_recognizer.recognize_faces(frame, current_user.id, confidence_threshold=100, **kwargs)
             
             if faces:
                 # Get best match
@@ -952,12 +1006,11 @@ def verify_face():
         return jsonify({'status': 'error', 'message': f"Server Error: {str(e)}"})
 
 @app.route('/stop_camera')
+@login_required
 def stop_camera():
-    """Stop the camera feed"""
-    global camera
-    if camera:
-        camera.release()
-        camera = None
+    """Stop the current user's camera feed"""
+    from camera_stream import stop_streams
+    stop_streams(current_user.id)
     return jsonify({'status': 'camera_stopped'})
 
 @app.route('/camera_feed')
@@ -966,100 +1019,18 @@ def stop_camera():
 def camera_feed(class_id=None):
     """Video streaming route with face recognition"""
     
-    # Capture user ID for the thread
-    user_id = current_user.id
-    
     # Store class_id in session for use in frame generation
     if class_id:
         session['current_class_id'] = class_id
     
-    def generate_frames():
-        camera = None
-        recognized_students = set()  # Track recognized students in this session
-        last_recognition_time = {}  # Track last recognition time for each student
-        
-        try:
-            # Try to open camera
-            for camera_index in [0, 1, 2]:
-                camera = cv2.VideoCapture(camera_index)
-                if camera.isOpened():
-                    print(f"✓ Camera {camera_index} opened")
-                    break
-                camera.release()
-                camera = None
-            
-            if camera is None:
-                # Generate error frame
-                frame = np.zeros((480, 640, 3), dtype=np.uint8)
-                cv2.putText(frame, "Camera Not Available", (150, 240),
-                           cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-                ret, buffer = cv2.imencode('.jpg', frame)
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-                return
-            
-            frame_count = 0
-            
-            while True:
-                success, frame = camera.read()
-                if not success:
-                    break
-                
-                frame_count += 1
-                
-                # Process every 3rd frame for performance
-                if frame_count % 3 == 0 and face_recognizer:
-                    try:
-                        # Recognize faces using user-specific model
-                        recognized_faces = face_recognizer.recognize_faces(frame, user_id)
-                        
-                        # Draw faces and mark attendance
-                        current_time = datetime.now()
-                        
-                        for face in recognized_faces:
-                            if face['student_id'] and face['name'] != "Unknown":
-                                student_id = face['student_id']
-                                
-                                # Check if we should mark attendance (not marked in last 5 seconds)
-                                if student_id not in last_recognition_time or \
-                                   (current_time - last_recognition_time[student_id]).seconds > 5:
-                                    
-                                    # Mark attendance
-                                    from database import mark_attendance
-                                    cls_id = session.get('current_class_id', 1)
-                                    
-                                    if mark_attendance(student_id, cls_id):
-                                        recognized_students.add(face['name'])
-                                        print(f"✓ Attendance marked for {face['name']}")
-                                    
-                                    last_recognition_time[student_id] = current_time
-                        
-                        # Draw faces on frame
-                        frame = face_recognizer.draw_faces(frame, recognized_faces)
-                        
-                        # Add info text
-                        cv2.putText(frame, f"Recognized: {len(recognized_students)}", 
-                                   (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                    
-                    except Exception as e:
-                        print(f"Recognition error: {e}")
-                
-                # Encode frame
-                ret, buffer = cv2.imencode('.jpg', frame)
-                frame_bytes = buffer.tobytes()
-                
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        
-        except Exception as e:
-            print(f"Camera error: {e}")
-        
-        finally:
-            if camera:
-                camera.release()
-                print("Camera released")
+    # One capture + recognition per camera, shared by every viewer of the same class
+    from camera_stream import get_stream, error_frame, multipart
+    stream = get_stream(face_recognizer, current_user.id, session.get('current_class_id', 1))
+    if stream is None:
+        return Response(multipart(error_frame("Camera in use by another user")),
+                        mimetype='multipart/x-mixed-replace; boundary=frame')
     
-    return Response(generate_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(stream.subscribe(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/mark_attendance_manual', methods=['POST'])
 def mark_attendance_manual():
@@ -1152,13 +1123,14 @@ def train_faces():
         return redirect(url_for('students'))
     
     try:
-        # Train model for THIS user
-        success, message = face_recognizer.train_user_model(current_user.id, STUDENT_IMAGES)
+        # Train model for THIS user in the background; progress is polled via /api/train/status
+        from training_jobs import submit_training
+        job_id, created = submit_training(face_recognizer, current_user.id, STUDENT_IMAGES)
         
-        if success:
-            flash(message, 'success')
+        if created:
+            flash('Training queued in the background. Progress is shown below.', 'info')
         else:
-            flash(f'Training failed: {message}', 'error')
+            flash('A training run is already queued; it will include your latest changes.', 'info')
     except Exception as e:
         flash(f'Training error: {str(e)}', 'error')
     
@@ -1199,6 +1171,42 @@ def api_stats():
     conn.close()
     return jsonify(stats)
 
+@app.route('/api/camera/status')
+@login_required
+def api_camera_status():
+    """Frame rates and adaptive recognition cadence of the current user's camera streams"""
+    from camera_stream import stream_stats
+    return jsonify({'streams': stream_stats(current_user.id)})
+
+@app.route('/api/train/status')
+@login_required
+def api_train_status():
+    """Status and per-student progress of the current user's latest (or given) training job"""
+    from database import get_training_job
+    from training_jobs import is_job_active
+    job = get_training_job(current_user.id, request.args.get('job_id', type=int))
+    if not job:
+        return jsonify({'status': 'none'})
+
+    status = job['status']
+    if status in ('queued', 'running') and not is_job_active(job):
+        status = 'stale'
+
+    students = [
+        {'student_id': int(s_id), 'name': p['name'], 'done': p['done'], 'total': p['total']}
+        for s_id, p in job['progress'].items()
+    ]
+    return jsonify({
+        'job_id': job['id'],
+        'status': status,
+        'message': job['message'],
+        'images_done': sum(s['done'] for s in students),
+        'images_total': sum(s['total'] for s in students),
+        'students': students,
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    })
+
 @app.route('/api/attendance/<date>')
 def api_attendance_by_date(date):
     """Get attendance for a specific date"""
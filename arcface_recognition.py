@@ -12,6 +12,8 @@ class ArcFaceRecognition:
         self.known_faces = {}
         self.face_embeddings = {}
         self.threshold = 0.6  # Similarity threshold
+        # {(shape, radius, neighbors): LBP sampling offsets and weights}
+        self.lbp_samplings = {}
         
     def load_known_faces(self):
         """Load known faces from database and images"""
@@ -99,6 +101,10 @@ class ArcFaceRecognition:
             # Different kernel sizes for multi-scale analysis
             kernel_sizes = [3, 5, 7, 9]
             
+            # Local Binary Pattern-like features (of the unblurred face, same for every scale)
+            lbp = self.calculate_lbp(face_normalized)
+            hist_lbp = cv2.calcHist([lbp], [0], None, [32], [0, 256])
+            
             for kernel_size in kernel_sizes:
                 # Apply Gaussian blur at different scales
                 blurred = cv2.GaussianBlur(face_normalized, (kernel_size, kernel_size), 0)
@@ -110,12 +116,8 @@ class ArcFaceRecognition:
                 # Gradient magnitude
                 grad_mag = np.sqrt(grad_x**2 + grad_y**2)
                 
-                # Local Binary Pattern-like features
-                lbp = self.calculate_lbp(face_normalized)
-                
                 # Histogram of gradients
                 hist_grad = cv2.calcHist([grad_mag.astype(np.uint8)], [0], None, [32], [0, 256])
-                hist_lbp = cv2.calcHist([lbp], [0], None, [32], [0, 256])
                 
                 # Combine features
                 combined = np.concatenate([
@@ -139,38 +141,44 @@ class ArcFaceRecognition:
             # Return random embedding as fallback
             return np.random.rand(256)
     
+    def lbp_sampling(self, shape, radius=1, neighbors=8):
+        """
+        Source rows/cols and bilinear weights of every LBP neighbour for an image
+        shape, as (x1, x2, y1, y2, w11, w21, w12, w22) per neighbour. Cached per shape.
+        """
+        key = (shape, radius, neighbors)
+        if key not in self.lbp_samplings:
+            h, w = shape
+            rows = np.arange(radius, h - radius)
+            cols = np.arange(radius, w - radius)
+            sampling = []
+            for n in range(neighbors):
+                angle = 2 * np.pi * n / neighbors
+                x = rows + radius * np.cos(angle)
+                y = cols + radius * np.sin(angle)
+                x1, y1 = x.astype(np.int64), y.astype(np.int64)
+                x2, y2 = np.minimum(x1 + 1, h - 1), np.minimum(y1 + 1, w - 1)
+                dx, dy = (x - x1)[:, None], (y - y1)[None, :]
+                sampling.append((x1, x2, y1, y2,
+                                 (1 - dx) * (1 - dy), dx * (1 - dy), (1 - dx) * dy, dx * dy))
+            self.lbp_samplings[key] = sampling
+        return self.lbp_samplings[key]
+
     def calculate_lbp(self, image, radius=1, neighbors=8):
-        """Calculate Local Binary Pattern"""
+        """Calculate Local Binary Pattern (border of `radius` pixels left 0)"""
         try:
             h, w = image.shape
             lbp = np.zeros((h, w), dtype=np.uint8)
-            
-            for i in range(radius, h - radius):
-                for j in range(radius, w - radius):
-                    center = image[i, j]
-                    
-                    binary = 0
-                    for n in range(neighbors):
-                        # Calculate neighbor position
-                        angle = 2 * np.pi * n / neighbors
-                        x = i + radius * np.cos(angle)
-                        y = j + radius * np.sin(angle)
-                        
-                        # Bilinear interpolation
-                        x1, y1 = int(x), int(y)
-                        x2, y2 = min(x1 + 1, h - 1), min(y1 + 1, w - 1)
-                        
-                        dx, dy = x - x1, y - y1
-                        neighbor_val = (1 - dx) * (1 - dy) * image[x1, y1] + \
-                                      dx * (1 - dy) * image[x2, y1] + \
-                                      (1 - dx) * dy * image[x1, y2] + \
-                                      dx * dy * image[x2, y2]
-                        
-                        if neighbor_val >= center:
-                            binary |= (1 << n)
-                    
-                    lbp[i, j] = binary
-            
+            # float64 like the per-pixel weights, so comparisons match the scalar formula exactly
+            image = np.asarray(image, dtype=np.float64)
+            center = image[radius:h - radius, radius:w - radius]
+            codes = lbp[radius:h - radius, radius:w - radius]
+
+            for n, (x1, x2, y1, y2, w11, w21, w12, w22) in enumerate(self.lbp_sampling((h, w), radius, neighbors)):
+                neighbor_val = (w11 * image[np.ix_(x1, y1)] + w21 * image[np.ix_(x2, y1)] +
+                                w12 * image[np.ix_(x1, y2)] + w22 * image[np.ix_(x2, y2)])
+                codes |= (neighbor_val >= center).astype(np.uint8) << n
+
             return lbp
             
         except Exception as e:
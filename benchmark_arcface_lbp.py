@@ -0,0 +1,106 @@
+"""
+Check and time ArcFaceRecognition's vectorized LBP against the original per-pixel loop.
+
+    python benchmark_arcface_lbp.py [image_dir] [--faces 20]
+
+Uses random 112x112 faces plus grayscale crops of any images under image_dir
+(default static/student_images). Fails if any LBP code or embedding differs.
+"""
+import argparse
+import sys
+import time
+import types
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from arcface_recognition import ArcFaceRecognition
+
+
+def reference_lbp(self, image, radius=1, neighbors=8):
+    """The original pure-Python calculate_lbp"""
+    h, w = image.shape
+    lbp = np.zeros((h, w), dtype=np.uint8)
+
+    for i in range(radius, h - radius):
+        for j in range(radius, w - radius):
+            center = image[i, j]
+
+            binary = 0
+            for n in range(neighbors):
+                angle = 2 * np.pi * n / neighbors
+                x = i + radius * np.cos(angle)
+                y = j + radius * np.sin(angle)
+
+                x1, y1 = int(x), int(y)
+                x2, y2 = min(x1 + 1, h - 1), min(y1 + 1, w - 1)
+
+                dx, dy = x - x1, y - y1
+                neighbor_val = (1 - dx) * (1 - dy) * image[x1, y1] + \
+                              dx * (1 - dy) * image[x2, y1] + \
+                              (1 - dx) * dy * image[x1, y2] + \
+                              dx * dy * image[x2, y2]
+
+                if neighbor_val >= center:
+                    binary |= (1 << n)
+
+            lbp[i, j] = binary
+
+    return lbp
+
+
+def sample_faces(image_dir, count):
+    rng = np.random.default_rng(0)
+    faces = [cv2.GaussianBlur(rng.integers(0, 256, (112, 112), dtype=np.uint8), (5, 5), 0)
+             for _ in range(count)]
+    for path in sorted(Path(image_dir).rglob('*'))[:count]:
+        if path.suffix.lower() in ('.jpg', '.jpeg', '.png'):
+            img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+            if img is not None:
+                faces.append(cv2.resize(img, (112, 112)))
+    return faces
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare vectorized and loop LBP in ArcFaceRecognition")
+    parser.add_argument('image_dir', nargs='?', default='static/student_images')
+    parser.add_argument('--faces', type=int, default=20, help="random faces (and max. images) to test")
+    args = parser.parse_args()
+
+    fast = ArcFaceRecognition()
+    slow = ArcFaceRecognition()
+    slow.calculate_lbp = types.MethodType(reference_lbp, slow)
+
+    faces = sample_faces(args.image_dir, args.faces)
+    mismatches = 0
+    times = {'loop': 0.0, 'vectorized': 0.0}
+    for face in faces:
+        normalized = face.astype(np.float32) / 255.0
+
+        start = time.perf_counter()
+        expected = slow.calculate_lbp(normalized)
+        times['loop'] += time.perf_counter() - start
+        start = time.perf_counter()
+        actual = fast.calculate_lbp(normalized)
+        times['vectorized'] += time.perf_counter() - start
+
+        if not np.array_equal(expected, actual):
+            mismatches += 1
+        elif not np.array_equal(slow.create_arcface_embedding(face), fast.create_arcface_embedding(face)):
+            mismatches += 1
+
+    print(f"{len(faces)} faces, {mismatches} mismatches")
+    for name, total in times.items():
+        print(f"  {name:<11}{total / len(faces) * 1000:>10.2f} ms per LBP")
+    print(f"  speedup    {times['loop'] / times['vectorized']:>10.0f}x")
+
+    start = time.perf_counter()
+    for face in faces:
+        fast.create_arcface_embedding(face)
+    print(f"  embedding  {(time.perf_counter() - start) / len(faces) * 1000:>10.2f} ms per face (vectorized)")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
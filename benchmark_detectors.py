@@ -0,0 +1,93 @@
+"""
+Compare lite-mode face detectors (Haar vs YuNet) on a folder of images.
+
+    python benchmark_detectors.py [image_dir] [--width 1920] [--repeat 3]
+
+Reports per-image latency and recall for each detector. Every image is assumed
+to hold one face (student enrollment photos) unless the folder contains a
+counts.json mapping file names to face counts (e.g. for group photos).
+Recall is count based: min(detected, expected) / expected, summed over images.
+"""
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from opencv_face_recognition import DETECTORS
+
+
+def load_images(image_dir, width=None):
+    """(name, color image, equalized gray) for every image under image_dir"""
+    images = []
+    for path in sorted(Path(image_dir).rglob('*')):
+        if path.suffix.lower() not in ('.jpg', '.jpeg', '.png'):
+            continue
+        img = cv2.imread(str(path))
+        if img is None:
+            continue
+        if width:
+            # Rescale to a fixed width, e.g. 1920 to time 1080p classroom frames
+            img = cv2.resize(img, (0, 0), fx=width / img.shape[1], fy=width / img.shape[1])
+        gray = cv2.equalizeHist(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+        images.append((str(path.relative_to(image_dir)), img, gray))
+    return images
+
+
+def load_counts(image_dir):
+    counts_path = os.path.join(image_dir, 'counts.json')
+    if os.path.exists(counts_path):
+        with open(counts_path) as f:
+            return json.load(f)
+    return {}
+
+
+def benchmark(detector, images, counts, repeat=3):
+    timings = []
+    found = expected = 0
+    for name, img, gray in images:
+        detector.detect(img, gray)  # warm-up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            faces = detector.detect(img, gray)
+        timings.append((time.perf_counter() - start) / repeat * 1000)
+
+        want = int(counts.get(name, 1))
+        found += min(len(faces), want)
+        expected += want
+    return np.array(timings), found, expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lite-mode face detectors")
+    parser.add_argument('image_dir', nargs='?', default='static/student_images')
+    parser.add_argument('--width', type=int, default=None, help="resize images to this width first")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per image")
+    parser.add_argument('--detectors', default=','.join(DETECTORS), help="comma separated, e.g. haar,yunet")
+    args = parser.parse_args()
+
+    images = load_images(args.image_dir, args.width)
+    if not images:
+        print(f"✗ No images found in {args.image_dir}")
+        return
+    counts = load_counts(args.image_dir)
+    print(f"{len(images)} images from {args.image_dir}" + (f" at width {args.width}" if args.width else ""))
+    print("=" * 60)
+    print(f"{'detector':<10}{'mean ms':>10}{'p95 ms':>10}{'recall':>10}{'faces':>12}")
+
+    for name in args.detectors.split(','):
+        try:
+            detector = DETECTORS[name.strip()]()
+        except Exception as e:
+            print(f"{name:<10} unavailable: {e}")
+            continue
+        timings, found, expected = benchmark(detector, images, counts, args.repeat)
+        print(f"{name:<10}{timings.mean():>10.1f}{np.percentile(timings, 95):>10.1f}"
+              f"{found / expected:>10.1%}{f'{found}/{expected}':>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import cv2
+import numpy as np
+
+# Encoded frames kept per stream; a subscriber that falls further behind skips to the newest
+RING_SIZE = 8
+# Release the device after this long without subscribers
+IDLE_SECONDS = 10.0
+# Seconds a subscriber waits for the next frame before ending its stream
+FRAME_TIMEOUT = 5.0
+# Seconds to wait for a replaced stream to release its camera
+RELEASE_TIMEOUT = 2.0
+# Device indices tried when opening the default camera
+CAMERA_INDICES = (0, 1, 2)
+# Seconds before the same student is marked again
+MARK_INTERVAL_SECONDS = 5
+# Frames over which the capture/stream frame rates are measured
+RATE_WINDOW = 30
+# Detection profile for live video, for recognizers with named profiles (AI mode)
+LIVE_PROFILE = 'live'
+
+# {device: CameraStream}, one capture per device for all viewers of the same user and class
+streams = {}
+streams_lock = threading.Lock()
+
+
+def get_stream(recognizer, user_id, class_id, device=None):
+    """
+    The running stream for a device (None = first camera that opens), started
+    for this user/class if needed. A stream for another class replaces the
+    running one if that belongs to the same user or has no viewers left; None
+    if another user's stream still has viewers (it keeps its own gallery).
+    """
+    with streams_lock:
+        stream = streams.get(device)
+        if stream is not None and stream.running:
+            if (stream.user_id, stream.class_id) == (user_id, class_id):
+                return stream
+            if stream.user_id != user_id and stream.subscribers > 0:
+                return None
+            stream.stop()
+            # The capture thread has to release the device before it can be opened again
+            stream.thread.join(timeout=RELEASE_TIMEOUT)
+        stream = CameraStream(recognizer, user_id, class_id, device)
+        streams[device] = stream
+        stream.start()
+        return stream
+
+
+def stream_stats(user_id=None):
+    """Frame rates and recognition cadence of the running streams (of one user, or all)"""
+    with streams_lock:
+        return [stream.stats() for stream in streams.values()
+                if stream.running and user_id in (None, stream.user_id)]
+
+
+def stop_streams(user_id=None):
+    """Stop the streams of one user, or all (their capture threads release the devices)"""
+    with streams_lock:
+        for device, stream in list(streams.items()):
+            if user_id in (None, stream.user_id):
+                stream.stop()
+                del streams[device]
+
+
+def error_frame(message):
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+    (width, _), _ = cv2.getTextSize(message, cv2.FONT_HERSHEY_SIMPLEX, 1, 2)
+    cv2.putText(frame, message, (max(10, (640 - width) // 2), 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    return cv2.imencode('.jpg', frame)[1].tobytes()
+
+
+def multipart(jpeg):
+    return b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n'
+
+
+class RateMeter:
+    """Events per second over the last RATE_WINDOW events"""
+
+    def __init__(self):
+        self.times = deque(maxlen=RATE_WINDOW)
+
+    def tick(self):
+        self.times.append(time.monotonic())
+
+    def rate(self):
+        if len(self.times) < 2 or self.times[-1] == self.times[0]:
+            return 0.0
+        return round((len(self.times) - 1) / (self.times[-1] - self.times[0]), 1)
+
+
+class LatestSlot:
+    """
+    Hand-over between pipeline stages: a put replaces any item not read yet
+    (latest frame wins), and every reader just asks for something newer than
+    what it saw last, so a slow stage skips frames instead of queueing them.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.seq = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.condition:
+            self.seq += 1
+            self.item = item
+            self.condition.notify_all()
+
+    def get(self, last_seq, timeout=FRAME_TIMEOUT):
+        """(seq, item) newer than last_seq; (last_seq, None) on timeout or once closed"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > last_seq or self.closed, timeout=timeout)
+            if self.seq > last_seq and not self.closed:
+                return self.seq, self.item
+            return last_seq, None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class CameraStream:
+    """
+    One capture pipeline per camera device, shared by all viewers, in three threads:
+    capture (reads at camera FPS), inference (tracking, recognition and attendance,
+    at whatever rate the CPU allows) and encode (draws the latest recognition
+    results on every captured frame and JPEG-encodes it once). Stages hand frames
+    over through LatestSlots; encoded frames go to a small ring buffer that any
+    number of MJPEG subscribers read from. Recognition and attendance use the
+    user/class the stream was started for.
+    """
+
+    def __init__(self, recognizer, user_id, class_id, device=None):
+        self.recognizer = recognizer
+        self.device = device
+        # Names this stream in recognizer state (e.g. the AI-mode pre-filter)
+        self.key = f'camera-{device}'
+        self.frames = deque(maxlen=RING_SIZE)  # (sequence number, jpeg bytes)
+        self.seq = 0
+        self.condition = threading.Condition()
+        self.subscribers = 0
+        self.idle_since = time.monotonic()
+        self.user_id = user_id
+        self.class_id = class_id
+        self.running = False
+        self.thread = None
+        self.captured = LatestSlot()  # (frame) from the capture thread
+        self.recognized_students = set()  # Students marked by this stream
+        self.tracker = None
+        self.capture_rate = RateMeter()
+        self.stream_rate = RateMeter()
+        self.recognition_rate = RateMeter()
+
+    def stats(self):
+        stats = {
+            'device': self.device,
+            'class_id': self.class_id,
+            'viewers': self.subscribers,
+            'capture_fps': self.capture_rate.rate(),
+            'stream_fps': self.stream_rate.rate(),
+            'recognition_fps': self.recognition_rate.rate(),
+        }
+        if self.tracker is not None:
+            stats.update(self.tracker.stats())
+        if hasattr(self.recognizer, 'prefilter_stats'):
+            stats['prefilter'] = self.recognizer.prefilter_stats(self.key)
+        return stats
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run_capture, name=f'camera-{self.device}', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.captured.close()
+
+    def open_camera(self):
+        for index in CAMERA_INDICES if self.device is None else (self.device,):
+            camera = cv2.VideoCapture(index)
+            if camera.isOpened():
+                print(f"✓ Camera {index} opened")
+                return camera
+            camera.release()
+        return None
+
+    def publish(self, jpeg):
+        with self.condition:
+            self.seq += 1
+            self.frames.append((self.seq, jpeg))
+            self.condition.notify_all()
+
+    def run_capture(self):
+        """Capture stage: read frames as fast as the camera delivers them"""
+        camera = self.open_camera()
+        if camera is None:
+            self.publish(error_frame("Camera Not Available"))
+            self.stop()
+            return
+
+        # Keeps identities between recognizer runs; recognition only reruns on motion or refresh
+        from face_tracker import FaceTracker
+        self.tracker = FaceTracker()
+        for stage in (self.run_inference, self.run_encode):
+            threading.Thread(target=stage, name=f'camera-{self.device}-{stage.__name__[4:]}', daemon=True).start()
+
+        try:
+            while self.running:
+                success, frame = camera.read()
+                if not success:
+                    break
+                self.captured.put(frame)
+                self.capture_rate.tick()
+
+                if self.subscribers == 0 and time.monotonic() - self.idle_since > IDLE_SECONDS:
+                    print(f"[INFO] No viewers for camera {self.device}, stopping")
+                    break
+        except Exception as e:
+            print(f"Camera error: {e}")
+        finally:
+            camera.release()
+            print("Camera released")
+            self.stop()
+
+    def run_inference(self):
+        """Inference stage: recognize the newest frame whenever the tracker asks for it"""
+        last_recognition_time = {}  # Last time each student was marked
+        last = 0
+        while self.running:
+            last, frame = self.captured.get(last)
+            if frame is None:
+                continue
+            if self.recognizer and self.user_id and self.tracker.needs_recognition(frame):
+                try:
+                    # Recognizers with a live-stream pre-filter (AI mode) get this stream's key
+                    kwargs = {'stream': self.key} if hasattr(self.recognizer, 'prefilter_stats') else {}
+                    if hasattr(self.recognizer, 'get_detector'):
+                        kwargs['profile'] = LIVE_PROFILE
+                    recognized_faces = self.recognizer.recognize_faces(frame, self.user_id, **kwargs)
+                    self.tracker.update(frame, recognized_faces)
+                    self.recognition_rate.tick()
+                    self.mark_attendance(recognized_faces, self.recognized_students, last_recognition_time)
+                except Exception as e:
+                    print(f"Recognition error: {e}")
+
+    def run_encode(self):
+        """Encode stage: overlay the latest results on every captured frame and publish it"""
+        last = 0
+        while self.running:
+            last, frame = self.captured.get(last)
+            if frame is None:
+                continue
+            try:
+                # Inference may still be reading this frame; draw on a copy
+                if self.recognizer:
+                    frame = self.tracker.draw(frame.copy())
+                    cv2.putText(frame, f"Recognized: {len(self.recognized_students)}",
+                                (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+
+                ret, buffer = cv2.imencode('.jpg', frame)
+                if ret:
+                    self.publish(buffer.tobytes())
+                    self.stream_rate.tick()
+            except Exception as e:
+                print(f"Encode error: {e}")
+
+    def mark_attendance(self, recognized_faces, recognized_students, last_recognition_time):
+        """Mark attendance for recognized students (at most every MARK_INTERVAL_SECONDS each)"""
+        from database import mark_attendance
+        current_time = datetime.now()
+        for face in recognized_faces:
+            if face['student_id'] and face['name'] != "Unknown":
+                student_id = face['student_id']
+                if student_id not in last_recognition_time or \
+                   (current_time - last_recognition_time[student_id]).seconds > MARK_INTERVAL_SECONDS:
+                    if mark_attendance(student_id, self.class_id or 1):
+                        recognized_students.add(face['name'])
+                        print(f"✓ Attendance marked for {face['name']}")
+                    last_recognition_time[student_id] = current_time
+
+    def subscribe(self):
+        """MJPEG multipart chunks for one viewer, until the stream stops or the viewer leaves"""
+        with self.condition:
+            self.subscribers += 1
+        last = 0
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.seq > last or not self.running, timeout=FRAME_TIMEOUT)
+                    pending = [entry for entry in self.frames if entry[0] > last]
+                    if not pending:
+                        break
+                    # Next frame in order, or the newest if frames were dropped before we got them
+                    seq, jpeg = pending[0] if pending[0][0] == last + 1 else pending[-1]
+                last = seq
+                yield multipart(jpeg)
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+                if self.subscribers == 0:
+                    self.idle_since = time.monotonic()
@@ -2,6 +2,8 @@ import sqlite3
 import os
 from datetime import datetime, timedelta
 import shutil
+import json
+import numpy as np
 
 
 
@@ -31,13 +33,17 @@ def delete_user_data(user_id):
                                  shutil.rmtree(path)
                          except: pass
 
+        # Delete face embeddings
+        cursor.execute('DELETE FROM face_encodings WHERE student_id IN (SELECT id FROM students WHERE class_id = ?)', (cls_id,))
         # Delete attendance
         cursor.execute('DELETE FROM attendance WHERE class_id = ?', (cls_id,))
         # Delete students
         cursor.execute('DELETE FROM students WHERE class_id = ?', (cls_id,))
         
-    # Delete classes
+    # Delete classes and training jobs
     cursor.execute('DELETE FROM classes WHERE user_id = ?', (user_id,))
+    cursor.execute('DELETE FROM training_jobs WHERE user_id = ?', (user_id,))
+    cursor.execute('DELETE FROM gallery_versions WHERE user_id = ?', (user_id,))
     
     # Delete user models
     try:
@@ -45,6 +51,19 @@ def delete_user_data(user_id):
             os.remove(f'models/user_{user_id}.yml')
         if os.path.exists(f'models/labels_{user_id}.pkl'):
             os.remove(f'models/labels_{user_id}.pkl')
+        if os.path.exists(f'models/lbph_{user_id}.json'):
+            os.remove(f'models/lbph_{user_id}.json')
+        from lbph_model import remove_matrix_files
+        remove_matrix_files(f'models/lbph_{user_id}')
+        if os.path.exists(f'models/embeddings_{user_id}.pkl'):
+            os.remove(f'models/embeddings_{user_id}.pkl')
+        if os.path.exists(f'models/ann_{user_id}.npz'):
+            os.remove(f'models/ann_{user_id}.npz')
+        if os.path.exists(f'models/embedding_cache_{user_id}.pkl'):
+            os.remove(f'models/embedding_cache_{user_id}.pkl')
+        for lock_kind in ('train', 'submit'):
+            if os.path.exists(f'models/{lock_kind}_{user_id}.lock'):
+                os.remove(f'models/{lock_kind}_{user_id}.lock')
     except: pass
 
     conn.commit()
@@ -162,17 +181,44 @@ def init_database():
     ''')
     
     # Create face_encodings table
+    # encoding_data holds the raw float32 bytes of one embedding (dims = 0 means no face found)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS face_encodings (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             student_id INTEGER,
             encoding_data TEXT NOT NULL,
             image_path TEXT,
+            model_name TEXT,
+            dims INTEGER DEFAULT 0,
+            content_hash TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (student_id) REFERENCES students (id)
         )
     ''')
     
+    # Create training_jobs table for background training runs
+    # progress holds JSON: {student_id: {'name', 'done', 'total'}}
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS training_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            status TEXT DEFAULT 'queued',
+            message TEXT,
+            progress TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Create gallery_versions table: bumped on every gallery change so each worker reloads
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gallery_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER DEFAULT 0
+        )
+    ''')
+    
     # Create sessions table for class sessions
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS sessions (
@@ -213,6 +259,16 @@ def init_database():
         cursor.execute("ALTER TABLE users ADD COLUMN reset_token TEXT")
         cursor.execute("ALTER TABLE users ADD COLUMN reset_token_expiry TIMESTAMP")
     
+    # Migration: Embedding metadata on face_encodings
+    try:
+        cursor.execute("SELECT model_name FROM face_encodings LIMIT 1")
+    except sqlite3.OperationalError:
+        print("Migrating DB: Adding embedding columns to face_encodings...")
+        cursor.execute("ALTER TABLE face_encodings ADD COLUMN model_name TEXT")
+        cursor.execute("ALTER TABLE face_encodings ADD COLUMN dims INTEGER DEFAULT 0")
+        cursor.execute("ALTER TABLE face_encodings ADD COLUMN content_hash TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_face_encodings_student ON face_encodings (student_id, model_name)")
+
     # Ensure active column exists for everyone if missing (safety)
     try:
          cursor.execute("SELECT is_active FROM students LIMIT 1")
@@ -484,25 +540,212 @@ def get_attendance_stats(class_id=None, start_date=None, end_date=None):
     conn.close()
     return stats
 
-def save_face_encoding(student_id, encoding_data, image_path):
-    """Save face encoding to database"""
+def save_face_encoding(student_id, encoding_data, image_path, model_name=None, content_hash=None):
+    """Save face encoding to database (NumPy vectors are stored as float32 BLOBs)"""
     conn = sqlite3.connect(DATABASE_FILE)
     cursor = conn.cursor()
     
+    dims = 0
+    if isinstance(encoding_data, np.ndarray):
+        dims = encoding_data.size
+        encoding_data = sqlite3.Binary(encoding_data.astype(np.float32).tobytes())
+    
     cursor.execute(
-        'INSERT INTO face_encodings (student_id, encoding_data, image_path) VALUES (?, ?, ?)',
-        (student_id, encoding_data, image_path)
+        'INSERT INTO face_encodings (student_id, encoding_data, image_path, model_name, dims, content_hash) VALUES (?, ?, ?, ?, ?, ?)',
+        (student_id, encoding_data, image_path, model_name, dims, content_hash)
     )
     
     conn.commit()
     conn.close()
 
+def face_encoding_rows(model_name, records):
+    """face_encodings rows for [(student_id, content_hash, image_path, vector or None)]"""
+    rows = []
+    for student_id, content_hash, image_path, vector in records:
+        if vector is None:
+            rows.append((student_id, sqlite3.Binary(b''), image_path, model_name, 0, content_hash))
+        else:
+            vector = np.asarray(vector, dtype=np.float32)
+            rows.append((student_id, sqlite3.Binary(vector.tobytes()), image_path, model_name, vector.size, content_hash))
+    return rows
+
+def save_user_face_encodings(user_id, model_name, records, student_ids):
+    """
+    Replace the stored embeddings of a user's trained students for one model.
+    records: [(student_id, content_hash, image_path, vector or None)]
+    student_ids: the students the training run read; rows of other students
+    (e.g. added while it ran) are left alone.
+    Runs in a single transaction so readers never see a half-written gallery.
+    """
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    try:
+        rows = face_encoding_rows(model_name, records)
+        with conn:
+            conn.executemany('''
+                DELETE FROM face_encodings
+                WHERE model_name = ? AND student_id = ? AND student_id IN (
+                    SELECT s.id FROM students s JOIN classes c ON s.class_id = c.id WHERE c.user_id = ?
+                )
+            ''', [(model_name, student_id, user_id) for student_id in student_ids])
+            conn.executemany(
+                'INSERT INTO face_encodings (student_id, encoding_data, image_path, model_name, dims, content_hash) VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+    finally:
+        conn.close()
+
+def save_student_face_encodings(student_id, model_name, records):
+    """Replace the stored embeddings of one student for one model (single transaction)"""
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    try:
+        rows = face_encoding_rows(model_name, records)
+        with conn:
+            conn.execute('DELETE FROM face_encodings WHERE student_id = ? AND model_name = ?',
+                         (student_id, model_name))
+            conn.executemany(
+                'INSERT INTO face_encodings (student_id, encoding_data, image_path, model_name, dims, content_hash) VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+    finally:
+        conn.close()
+
+def get_face_encoding_cache(user_id, model_name):
+    """Stored embeddings of a user's students keyed by image content hash (None = no face)"""
+    conn = sqlite3.connect(DATABASE_FILE)
+    rows = conn.execute('''
+        SELECT fe.content_hash, fe.encoding_data, fe.dims
+        FROM face_encodings fe
+        JOIN students s ON fe.student_id = s.id
+        JOIN classes c ON s.class_id = c.id
+        WHERE c.user_id = ? AND fe.model_name = ? AND fe.content_hash IS NOT NULL
+    ''', (user_id, model_name)).fetchall()
+    conn.close()
+
+    cache = {}
+    for content_hash, data, dims in rows:
+        cache[content_hash] = np.frombuffer(data, dtype=np.float32).copy() if dims else None
+    return cache
+
+def load_face_encodings(user_id, model_name, student_id=None):
+    """
+    Load every embedding of a user's active students (or just one student) with one query.
+    Returns (matrix, student_ids, names): an (n, dims) float32 matrix plus
+    parallel lists, ordered by student so the layout is stable between loads.
+    """
+    query = '''
+        SELECT fe.student_id, s.name, fe.encoding_data, fe.dims
+        FROM face_encodings fe
+        JOIN students s ON fe.student_id = s.id
+        JOIN classes c ON s.class_id = c.id
+        WHERE c.user_id = ? AND s.is_active = 1 AND fe.model_name = ? AND fe.dims > 0
+    '''
+    params = [user_id, model_name]
+    if student_id is not None:
+        query += ' AND fe.student_id = ?'
+        params.append(student_id)
+    query += ' ORDER BY fe.student_id, fe.id'
+
+    conn = sqlite3.connect(DATABASE_FILE)
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32), [], []
+
+    dims = rows[0][3]
+    rows = [r for r in rows if r[3] == dims]
+    matrix = np.frombuffer(b''.join(r[2] for r in rows), dtype=np.float32).reshape(len(rows), dims)
+    return matrix, [r[0] for r in rows], [r[1] for r in rows]
+
+def get_student_owner(student_id):
+    """(user_id, name, is_active) of a student via its class, or None"""
+    conn = sqlite3.connect(DATABASE_FILE)
+    row = conn.execute('''
+        SELECT c.user_id, s.name, s.is_active
+        FROM students s
+        JOIN classes c ON s.class_id = c.id
+        WHERE s.id = ?
+    ''', (student_id,)).fetchone()
+    conn.close()
+    return row
+
+def get_gallery_version(user_id):
+    """Counter bumped whenever a user's face gallery changes (0 if never)"""
+    conn = sqlite3.connect(DATABASE_FILE)
+    row = conn.execute('SELECT version FROM gallery_versions WHERE user_id = ?', (user_id,)).fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+def bump_gallery_version(user_id):
+    """Mark a user's gallery as changed so other processes reload it; returns the new version"""
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    with conn:
+        conn.execute('''
+            INSERT INTO gallery_versions (user_id, version) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET version = version + 1
+        ''', (user_id,))
+        version = conn.execute('SELECT version FROM gallery_versions WHERE user_id = ?', (user_id,)).fetchone()[0]
+    conn.close()
+    return version
+
+def create_training_job(user_id):
+    """Record a queued training job and return its id"""
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO training_jobs (user_id, status, progress) VALUES (?, 'queued', '{}')",
+        (user_id,)
+    )
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+def update_training_job(job_id, status=None, message=None, progress=None):
+    """Update state, result message and/or per-student progress of a training job"""
+    fields, values = ['updated_at = CURRENT_TIMESTAMP'], []
+    if status is not None:
+        fields.append('status = ?')
+        values.append(status)
+    if message is not None:
+        fields.append('message = ?')
+        values.append(message)
+    if progress is not None:
+        fields.append('progress = ?')
+        values.append(json.dumps(progress))
+
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    conn.execute(f"UPDATE training_jobs SET {', '.join(fields)} WHERE id = ?", values + [job_id])
+    conn.commit()
+    conn.close()
+
+def get_training_job(user_id, job_id=None):
+    """A user's training job (latest one if job_id is None) as a dict, or None"""
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if job_id is None:
+        row = conn.execute(
+            'SELECT * FROM training_jobs WHERE user_id = ? ORDER BY id DESC LIMIT 1', (user_id,)
+        ).fetchone()
+    else:
+        row = conn.execute(
+            'SELECT * FROM training_jobs WHERE user_id = ? AND id = ?', (user_id, job_id)
+        ).fetchone()
+    conn.close()
+
+    if row is None:
+        return None
+    job = dict(row)
+    job['progress'] = json.loads(job['progress'] or '{}')
+    return job
+
 def delete_class(class_id):
     """Hard delete a class and its students completely"""
     conn = sqlite3.connect(DATABASE_FILE)
     cursor = conn.cursor()
-    # 1. Delete Attendance for this class
+    # 1. Delete Attendance and face embeddings for this class
     cursor.execute('DELETE FROM attendance WHERE class_id = ?', (class_id,))
+    cursor.execute('DELETE FROM face_encodings WHERE student_id IN (SELECT id FROM students WHERE class_id = ?)', (class_id,))
     
     # 2. Delete Students in this class
     # (Attendance also references students, so deleting students might be redundant if we del attendance by class_id above, 
@@ -0,0 +1,227 @@
+import os
+import numpy as np
+
+# Galleries with fewer rows than this are scanned exactly; larger ones get an IVF index.
+# Below ~8000 rows (512-d) the exact matmul is about as fast as IVF search and needs no k-means rebuild.
+ANN_MIN_ROWS = int(os.environ.get('ANN_MIN_ROWS', '8000'))
+# Number of inverted lists probed per query (more = better recall, slower)
+ANN_N_PROBE = 8
+# Nearest prototypes that vote on each face's identity
+KNN_K = 3
+
+
+def normalize_rows(matrix):
+    """L2-normalize every row of a 2D float32 matrix (zero rows stay zero)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def spherical_kmeans(matrix, k, n_iter=10, seed=0):
+    """
+    Cosine k-means on unit-length rows.
+    Returns (centroids, assignments); deterministic for a given seed.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    k = max(1, min(k, len(matrix)))
+    rng = np.random.default_rng(seed)
+    centroids = matrix[rng.choice(len(matrix), k, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignments = np.argmax(matrix @ centroids.T, axis=1)
+        # Per-cluster sums via a one-hot matmul (much faster than np.add.at)
+        one_hot = np.zeros((k, len(matrix)), dtype=np.float32)
+        one_hot[assignments, np.arange(len(matrix))] = 1.0
+        sums = one_hot @ matrix
+        counts = np.bincount(assignments, minlength=k)
+
+        # Re-seed empty clusters from random rows
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = matrix[rng.choice(len(matrix), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+
+    assignments = np.argmax(matrix @ centroids.T, axis=1)
+    return centroids, assignments
+
+
+def top_k(rows, scores, k):
+    """Pick the k best (row, score) pairs of a 1D candidate list, best first"""
+    if len(scores) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        rows, scores = rows[part], scores[part]
+    order = np.argsort(-scores, kind='stable')
+    rows, scores = rows[order], scores[order]
+
+    # Pad short lists with a zero-weight copy of the best row
+    if len(rows) < k:
+        pad = k - len(rows)
+        rows = np.concatenate([rows, np.full(pad, rows[0] if len(rows) else 0, dtype=np.int64)])
+        scores = np.concatenate([scores, np.full(pad, -1.0, dtype=np.float32)])
+    return rows, scores
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest neighbour index over a gallery matrix.
+    Rows are bucketed under k-means centroids; a query only scans the rows of
+    its `n_probe` closest buckets, which are then re-ranked exactly.
+    """
+
+    def __init__(self, centroids, list_offsets, list_rows, student_ids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.list_rows = np.asarray(list_rows, dtype=np.int64)
+        # Row -> student mapping the index was built for (used to detect a stale file)
+        self.student_ids = np.asarray(student_ids, dtype=np.int64)
+
+    @classmethod
+    def build(cls, matrix, student_ids, n_lists=None):
+        """Cluster the gallery rows into ~sqrt(N) inverted lists"""
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(matrix)))
+        centroids, assignments = spherical_kmeans(matrix, n_lists)
+
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=len(centroids))
+        list_offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(centroids, list_offsets, order, student_ids)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['centroids'], data['list_offsets'], data['list_rows'], data['student_ids'])
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets,
+                 list_rows=self.list_rows, student_ids=self.student_ids)
+
+    def matches(self, student_ids):
+        """True if the index was built for exactly this row -> student layout"""
+        return np.array_equal(self.student_ids, np.asarray(student_ids, dtype=np.int64))
+
+    def search(self, matrix, probes, k=1, n_probe=ANN_N_PROBE):
+        """
+        Approximate top-k gallery rows for each (unit-length) probe.
+        Every probed list is scored exactly against all probes that chose it
+        with one matmul, so the cost is ~n_probe/n_lists of a full scan.
+        Returns (rows, scores), both shaped (n_probes, k), best first.
+        """
+        n_probe = min(n_probe, len(self.centroids))
+        coarse = probes @ self.centroids.T
+        top_lists = np.argpartition(-coarse, n_probe - 1, axis=1)[:, :n_probe]
+
+        cand_rows = [[] for _ in range(len(probes))]
+        cand_scores = [[] for _ in range(len(probes))]
+        for l in np.unique(top_lists):
+            rows = self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]]
+            if len(rows) == 0:
+                continue
+            probe_idx = np.nonzero((top_lists == l).any(axis=1))[0]
+            scores = probes[probe_idx] @ matrix[rows].T
+            for i, p in enumerate(probe_idx):
+                cand_rows[p].append(rows)
+                cand_scores[p].append(scores[i])
+
+        out_rows = np.zeros((len(probes), k), dtype=np.int64)
+        out_scores = np.full((len(probes), k), -1.0, dtype=np.float32)
+        for p in range(len(probes)):
+            if cand_rows[p]:
+                out_rows[p], out_scores[p] = top_k(np.concatenate(cand_rows[p]),
+                                                   np.concatenate(cand_scores[p]), k)
+        return out_rows, out_scores
+
+
+class FaceGallery:
+    """
+    Per-user face gallery kept as one contiguous float32 matrix.
+    Row i of `matrix` belongs to `student_ids[i]` / `names[i]`, so a whole
+    frame of faces is scored against every student with one matrix multiply.
+    A student may own several rows (one per prototype embedding).
+    """
+
+    def __init__(self, matrix, student_ids, names):
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.student_ids = np.asarray(student_ids, dtype=np.int64)
+        self.names = np.asarray(names, dtype=object)
+        # Optional IVFIndex; None means exact brute-force matching
+        self.index = None
+
+    @classmethod
+    def from_embeddings(cls, embeddings):
+        """
+        Build from the {student_id: {'name', 'vectors'}} dict saved by train_user_model.
+        Older pickles only have a single mean 'vector' per student.
+        """
+        blocks, student_ids, names = [], [], []
+        for s_id, data in embeddings.items():
+            vectors = data.get('vectors')
+            if vectors is None:
+                vectors = data['vector']
+            vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+
+            blocks.append(vectors)
+            student_ids.extend([s_id] * len(vectors))
+            names.extend([data['name']] * len(vectors))
+
+        if not blocks:
+            return cls(np.zeros((0, 0), dtype=np.float32), [], [])
+        return cls(normalize_rows(np.concatenate(blocks)), student_ids, names)
+
+    def __len__(self):
+        return len(self.student_ids)
+
+    def build_index(self):
+        """Attach an ANN index if the gallery is large enough to benefit from one"""
+        if len(self) >= ANN_MIN_ROWS:
+            self.index = IVFIndex.build(self.matrix, self.student_ids)
+        else:
+            self.index = None
+        return self.index
+
+    def load_index(self, path):
+        """Attach a saved index if it still matches this gallery, otherwise rebuild it"""
+        if len(self) < ANN_MIN_ROWS:
+            self.index = None
+            return None
+        try:
+            index = IVFIndex.load(path)
+            if index.matches(self.student_ids):
+                self.index = index
+                return index
+        except Exception as e:
+            print(f"[WARN] Could not load ANN index {path}: {e}")
+        return self.build_index()
+
+    def top_k(self, probes, k):
+        """Top-k rows and scores for each unit-length probe, best first"""
+        k = min(k, len(self))
+        if self.index is not None:
+            return self.index.search(self.matrix, probes, k=k)
+
+        scores = probes @ self.matrix.T
+        rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, rows, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        return np.take_along_axis(rows, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def match(self, vectors, k=KNN_K, min_score=0.0):
+        """
+        Identify every probe vector at once with a k-NN vote.
+        The k closest prototypes vote for their student, weighted by similarity
+        (only candidates above `min_score` count); the winner is reported with
+        its best-matching row and score. Returns (best_rows, best_scores).
+        """
+        probes = normalize_rows(np.atleast_2d(vectors))
+        rows, scores = self.top_k(probes, k)
+
+        weights = np.where(scores > min_score, scores, 0.0)
+        owners = self.student_ids[rows]
+        same = owners[:, :, None] == owners[:, None, :]
+        votes = (same * weights[:, None, :]).sum(axis=2)
+
+        # argmax picks the first (= highest scoring) candidate of the winning student
+        winner = np.argmax(votes, axis=1)
+        picked = np.arange(len(probes))
+        return rows[picked, winner], scores[picked, winner]
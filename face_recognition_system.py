@@ -1,4 +1,7 @@
 import cv2
+import hashlib
+import json
+import multiprocessing
 import numpy as np
 import os
 import pickle
@@ -7,52 +10,138 @@ import sqlite3
 from datetime import datetime
 from pathlib import Path
 
+# Processes used by train_from_images (1 = train in this process)
+TRAIN_WORKERS = int(os.environ.get('TRAIN_WORKERS', '1'))
+# Images wider than this are downscaled before HOG detection
+MAX_IMAGE_WIDTH = 1024
+
+
+def encode_image(img_path):
+    """
+    Pool task: decode one image, downscale it if oversized and return
+    (encoding of the first face or None, error message or None).
+    """
+    try:
+        # Load image (RGB)
+        image = face_recognition.load_image_file(str(img_path))
+        height, width = image.shape[:2]
+        if width > MAX_IMAGE_WIDTH:
+            scale = MAX_IMAGE_WIDTH / width
+            image = cv2.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        # Detect faces and get encodings
+        face_locations = face_recognition.face_locations(image, model='hog')
+        face_encodings = face_recognition.face_encodings(image, face_locations)
+        # Use the first face found
+        return (face_encodings[0] if face_encodings else None), None
+    except Exception as e:
+        return None, str(e)
+
+
 class AdvancedFaceRecognition:
     """Advanced face recognition using face_recognition library (dlib-based)"""
     
-    def __init__(self, encodings_file='face_encodings.pkl'):
+    def __init__(self, encodings_file='face_encodings.npy'):
+        # Encodings matrix (.npy, memory-mapped) with names/ids in a .json next to it
         self.encodings_file = encodings_file
-        self.known_encodings = []
+        self.labels_file = os.path.splitext(encodings_file)[0] + '.json'
+        # Per-image results of earlier training runs, by image content hash
+        self.cache_file = os.path.splitext(encodings_file)[0] + '_cache.npz'
+        self.known_encodings = np.zeros((0, 128))
         self.known_names = []
         self.known_ids = []
         self.load_encodings()
     
     def load_encodings(self):
-        """Load face encodings from pickle file"""
-        if os.path.exists(self.encodings_file):
+        """Memory-map the encodings matrix (rows are read on first use) and load names/ids"""
+        legacy_file = os.path.splitext(self.encodings_file)[0] + '.pkl'
+        if not os.path.exists(self.labels_file) and os.path.exists(legacy_file):
+            self.convert_pickle(legacy_file)
+
+        if os.path.exists(self.labels_file) and os.path.exists(self.encodings_file):
             try:
-                with open(self.encodings_file, 'rb') as f:
-                    data = pickle.load(f)
-                    self.known_encodings = data.get('encodings', [])
-                    self.known_names = data.get('names', [])
-                    self.known_ids = data.get('ids', [])
+                with open(self.labels_file) as f:
+                    data = json.load(f)
+                self.known_encodings = np.load(self.encodings_file, mmap_mode='r')
+                self.known_names = data.get('names', [])
+                self.known_ids = data.get('ids', [])
                 print(f"✓ Loaded {len(self.known_encodings)} face encodings")
             except Exception as e:
                 print(f"Error loading encodings: {e}")
-                self.known_encodings = []
+                self.known_encodings = np.zeros((0, 128))
                 self.known_names = []
                 self.known_ids = []
         else:
             print("No encodings file found. Please train the system first.")
+
+    def convert_pickle(self, legacy_file):
+        """One-time conversion of the old face_encodings.pkl (lists of encodings)"""
+        try:
+            with open(legacy_file, 'rb') as f:
+                data = pickle.load(f)
+            self.known_encodings = np.array(data.get('encodings', []), dtype=np.float64).reshape(-1, 128)
+            self.known_names = list(data.get('names', []))
+            self.known_ids = [int(i) for i in data.get('ids', [])]
+            if self.save_encodings():
+                os.remove(legacy_file)
+                print(f"✓ Converted {legacy_file} to {self.encodings_file}")
+        except Exception as e:
+            print(f"Error converting {legacy_file}: {e}")
     
     def save_encodings(self):
-        """Save face encodings to pickle file"""
+        """Save the encodings matrix (.npy) and names/ids (.json); the .json is replaced last"""
         try:
+            with open(self.encodings_file + '.tmp', 'wb') as f:
+                np.save(f, np.asarray(self.known_encodings, dtype=np.float64))
+            os.replace(self.encodings_file + '.tmp', self.encodings_file)
+
             data = {
-                'encodings': self.known_encodings,
                 'names': self.known_names,
                 'ids': self.known_ids
             }
-            with open(self.encodings_file, 'wb') as f:
-                pickle.dump(data, f)
+            with open(self.labels_file + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(self.labels_file + '.tmp', self.labels_file)
             print(f"✓ Saved {len(self.known_encodings)} face encodings")
             return True
         except Exception as e:
             print(f"Error saving encodings: {e}")
             return False
     
-    def train_from_images(self, student_images_dir='static/student_images'):
-        """Train face recognition from student images"""
+    def load_image_cache(self):
+        """{image content hash: encoding, or None if the image had no face}"""
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with np.load(self.cache_file) as data:
+                return {h: (enc if found else None)
+                        for h, enc, found in zip(data['hashes'], data['encodings'], data['found'])}
+        except Exception as e:
+            print(f"Error loading image cache: {e}")
+            return {}
+
+    def save_image_cache(self, cache):
+        try:
+            hashes = sorted(cache)
+            encodings = np.zeros((len(hashes), 128))
+            for i, h in enumerate(hashes):
+                if cache[h] is not None:
+                    encodings[i] = cache[h]
+            with open(self.cache_file + '.tmp', 'wb') as f:
+                np.savez(f, hashes=np.array(hashes, dtype=str), encodings=encodings,
+                         found=np.array([cache[h] is not None for h in hashes], dtype=bool))
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except Exception as e:
+            print(f"Error saving image cache: {e}")
+
+    def train_from_images(self, student_images_dir='static/student_images', workers=None):
+        """
+        Train face recognition from student images.
+        Images already encoded by an earlier run (same content hash) are taken
+        from the image cache; the rest are encoded, in a process pool with
+        workers > 1 (default TRAIN_WORKERS). Results are merged in student and
+        file name order, so the saved encodings do not depend on worker timing.
+        """
         print("=" * 50)
         print("Starting Face Recognition Training...")
         print("=" * 50)
@@ -72,14 +161,8 @@ class AdvancedFaceRecognition:
             print("No active students found in database")
             return False
         
-        # Reset encodings
-        self.known_encodings = []
-        self.known_names = []
-        self.known_ids = []
-        
-        total_images = 0
-        total_faces = 0
-        
+        # (student_id, student_name, [(image path, content hash)])
+        student_images = []
         for student_id, student_name in students:
             student_folder = os.path.join(student_images_dir, student_name.lower().replace(' ', '_'))
             
@@ -87,8 +170,6 @@ class AdvancedFaceRecognition:
                 print(f"⚠ No images found for {student_name}")
                 continue
             
-            print(f"\nProcessing {student_name}...")
-            
             # Get all image files
             image_files = []
             for ext in ['*.jpg', '*.jpeg', '*.png', '*.JPG', '*.JPEG', '*.PNG']:
@@ -98,47 +179,81 @@ class AdvancedFaceRecognition:
                 print(f"  ⚠ No image files found in {student_folder}")
                 continue
             
-            student_encodings = []
-            
-            for img_path in image_files:
+            images = []
+            for img_path in sorted(set(image_files)):
                 try:
-                    # Load image
-                    image = face_recognition.load_image_file(str(img_path))
-                    
-                    # Detect faces and get encodings
-                    face_locations = face_recognition.face_locations(image, model='hog')
-                    face_encodings = face_recognition.face_encodings(image, face_locations)
-                    
-                    if len(face_encodings) > 0:
-                        # Use the first face found
-                        encoding = face_encodings[0]
-                        student_encodings.append(encoding)
-                        total_images += 1
-                        total_faces += 1
-                        print(f"  ✓ Processed {img_path.name}")
-                    else:
-                        print(f"  ✗ No face detected in {img_path.name}")
-                
+                    images.append((img_path, hashlib.sha1(img_path.read_bytes()).hexdigest()))
                 except Exception as e:
-                    print(f"  ✗ Error processing {img_path.name}: {e}")
+                    print(f"  ✗ Error reading {img_path.name}: {e}")
+            student_images.append((student_id, student_name, images))
+        
+        # Encode only images not seen before (one task per distinct image)
+        cache = self.load_image_cache()
+        pending = {}
+        for _, _, images in student_images:
+            for img_path, h in images:
+                if h not in cache:
+                    pending.setdefault(h, img_path)
+        
+        if workers is None:
+            workers = TRAIN_WORKERS
+        workers = min(workers, len(pending))
+        hashes = list(pending)
+        print(f"Encoding {len(hashes)} new images ({len(cache)} cached)"
+              + (f" on {workers} processes" if workers > 1 else ""))
+        if workers > 1:
+            # Spawned, not forked: a forked child could inherit locks held by the caller's other threads
+            with multiprocessing.get_context('spawn').Pool(workers) as pool:
+                results = pool.map(encode_image, [pending[h] for h in hashes], chunksize=4)
+        else:
+            results = [encode_image(pending[h]) for h in hashes]
+        
+        for h, (encoding, error) in zip(hashes, results):
+            if error:
+                # Not cached, so it is retried next run
+                print(f"  ✗ Error processing {pending[h].name}: {error}")
+            else:
+                cache[h] = encoding
+        
+        # Merge in student / file order
+        encodings = []
+        names = []
+        ids = []
+        total_images = 0
+        
+        for student_id, student_name, images in student_images:
+            student_encodings = [cache[h] for _, h in images if cache.get(h) is not None]
+            missed = len(images) - len(student_encodings)
+            total_images += len(images)
             
             # Add all encodings for this student
+            for encoding in student_encodings:
+                encodings.append(encoding)
+                names.append(student_name)
+                ids.append(student_id)
             if student_encodings:
-                for encoding in student_encodings:
-                    self.known_encodings.append(encoding)
-                    self.known_names.append(student_name)
-                    self.known_ids.append(student_id)
-                print(f"  ✓ Added {len(student_encodings)} face encoding(s) for {student_name}")
+                print(f"  ✓ Added {len(student_encodings)} face encoding(s) for {student_name}"
+                      + (f" ({missed} image(s) without a face)" if missed else ""))
+            else:
+                print(f"  ✗ No face detected in {len(images)} image(s) of {student_name}")
+        
+        # Drop entries for images that no longer exist
+        current = {h for _, _, images in student_images for _, h in images}
+        self.save_image_cache({h: enc for h, enc in cache.items() if h in current})
+        
+        self.known_encodings = np.array(encodings, dtype=np.float64).reshape(-1, 128)
+        self.known_names = names
+        self.known_ids = ids
         
         print("\n" + "=" * 50)
         print(f"Training Complete!")
         print(f"Total Images Processed: {total_images}")
-        print(f"Total Face Encodings: {total_faces}")
+        print(f"Total Face Encodings: {len(encodings)}")
         print(f"Students Trained: {len(set(self.known_names))}")
         print("=" * 50)
         
         # Save encodings
-        if self.known_encodings:
+        if len(self.known_encodings):
             return self.save_encodings()
         else:
             print("No face encodings were created. Please check your images.")
@@ -155,7 +270,7 @@ class AdvancedFaceRecognition:
         Returns:
             List of (name, student_id, location) tuples
         """
-        if not self.known_encodings:
+        if not len(self.known_encodings):
             return []
         
         # Convert BGR to RGB
@@ -170,28 +285,26 @@ class AdvancedFaceRecognition:
         
         recognized_faces = []
         
-        for face_encoding, face_location in zip(face_encodings, face_locations):
-            # Compare with known faces
-            matches = face_recognition.compare_faces(
-                self.known_encodings, 
-                face_encoding, 
-                tolerance=tolerance
+        # Distances of every face to every known encoding, computed once
+        # (same Euclidean distance face_recognition.face_distance/compare_faces use)
+        if face_encodings:
+            distances = np.linalg.norm(
+                np.asarray(self.known_encodings)[None, :, :] - np.asarray(face_encodings)[:, None, :], axis=2
             )
-            
+        
+        for i, face_location in enumerate(face_locations):
             name = "Unknown"
             student_id = None
             confidence = 0
             
-            # Calculate face distances
-            face_distances = face_recognition.face_distance(self.known_encodings, face_encoding)
+            face_distances = distances[i]
+            best_match_index = np.argmin(face_distances)
             
-            if len(face_distances) > 0:
-                best_match_index = np.argmin(face_distances)
-                
-                if matches[best_match_index]:
-                    name = self.known_names[best_match_index]
-                    student_id = self.known_ids[best_match_index]
-                    confidence = 1 - face_distances[best_match_index]
+            # A match is within tolerance, like compare_faces
+            if face_distances[best_match_index] <= tolerance:
+                name = self.known_names[best_match_index]
+                student_id = self.known_ids[best_match_index]
+                confidence = 1 - face_distances[best_match_index]
             
             # Scale back up face locations
             top, right, bottom, left = face_location
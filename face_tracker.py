@@ -0,0 +1,186 @@
+import time
+import cv2
+import numpy as np
+
+# Re-run recognition at least this often, even in a still scene
+REFRESH_SECONDS = 3.0
+# The refresh interval doubles up to this while refreshes keep finding the same faces
+MAX_REFRESH_SECONDS = 30.0
+# Never recognize more often than this (seconds between run starts)
+MIN_RECOGNITION_INTERVAL = 0.1
+# Share of the time recognition may take; slower runs stretch the gap between runs
+MAX_RECOGNITION_DUTY = 0.5
+# Weight of the newest run in the smoothed recognition latency
+LATENCY_SMOOTHING = 0.3
+# Width of the grayscale copy used for motion checks
+MOTION_WIDTH = 160
+# Gray level change that counts a (small frame) pixel as moving
+MOTION_PIXEL_DELTA = 25
+# A track is considered lost when this fraction of its box moved
+TRACK_MOTION_FRACTION = 0.2
+# A new face may have appeared when this fraction of the untracked area moved
+SCENE_MOTION_FRACTION = 0.02
+# Minimum overlap for a new result to continue an existing track
+TRACK_IOU = 0.3
+# Recognizer runs a track keeps its identity while the face comes back "Unknown"
+TRACK_KEEP_RUNS = 2
+
+
+def iou(a, b):
+    """Intersection over union of two (x, y, w, h) boxes"""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    w = min(ax + aw, bx + bw) - max(ax, bx)
+    h = min(ay + ah, by + bh) - max(ay, by)
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    return inter / float(aw * ah + bw * bh - inter)
+
+
+class FaceTracker:
+    """
+    Keeps the recognized faces of one camera stream between recognizer runs and
+    decides when the recognizer has to run again (adaptive cadence):
+    - on motion: a tracked face moved, or something changed outside the tracked
+      faces (a new face may have appeared), checked against the last run's frame;
+    - on refresh: the refresh interval starts at REFRESH_SECONDS and doubles (up
+      to MAX_REFRESH_SECONDS) while refreshes find the same faces in a still room;
+    - never sooner than the minimum interval, which grows with the measured
+      recognition latency so recognition takes at most MAX_RECOGNITION_DUTY of the time.
+    Runs are matched to the previous tracks by IoU.
+    """
+
+    def __init__(self, refresh_seconds=REFRESH_SECONDS):
+        self.base_refresh_seconds = refresh_seconds
+        self.refresh_seconds = refresh_seconds
+        self.tracks = []  # recognizer results (dicts with 'rect'), plus 'unknown_runs'
+        self.reference = None  # small gray frame of the last run
+        self.scale = 1.0
+        self.last_run = 0.0
+        self.run_started = None
+        self.reason = None  # why the pending run was scheduled
+        self.latency = 0.0  # smoothed seconds per recognizer run
+        self.motion = 0.0  # share of moving pixels in the last checked frame
+        self.frames = 0
+        self.skipped = 0
+        self.runs = {'start': 0, 'motion': 0, 'refresh': 0}
+
+    def min_interval(self):
+        """Seconds between run starts: recognition may take MAX_RECOGNITION_DUTY of the time"""
+        return max(MIN_RECOGNITION_INTERVAL, self.latency / MAX_RECOGNITION_DUTY)
+
+    def schedule(self, reason):
+        self.reason = reason
+        self.run_started = time.monotonic()
+        return True
+
+    def stats(self):
+        """Current cadence for monitoring"""
+        total_runs = sum(self.runs.values())
+        return {
+            'frames_checked': self.frames,
+            'frames_skipped': self.skipped,
+            'recognition_runs': dict(self.runs),
+            'recognition_latency_ms': round(self.latency * 1000, 1),
+            'min_interval_ms': round(self.min_interval() * 1000, 1),
+            'refresh_seconds': self.refresh_seconds,
+            'motion': round(self.motion, 4),
+            'recognized_share': round(total_runs / self.frames, 4) if self.frames else 0.0,
+        }
+
+    def motion_frame(self, frame):
+        """Small blurred grayscale copy of the frame for motion checks"""
+        self.scale = min(1.0, MOTION_WIDTH / frame.shape[1])
+        small = cv2.resize(frame, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def needs_recognition(self, frame):
+        """True if the recognizer should run on this frame (call update() with its results)"""
+        self.frames += 1
+        if self.reference is None:
+            return self.schedule('start')
+        since_run = time.monotonic() - self.last_run
+        if since_run < self.min_interval():
+            self.skipped += 1
+            return False
+        if since_run >= self.refresh_seconds:
+            return self.schedule('refresh')
+        if self.scene_changed(frame):
+            return self.schedule('motion')
+        self.skipped += 1
+        return False
+
+    def scene_changed(self, frame):
+        """Motion check against the last run's frame: a tracked face moved or something appeared"""
+        small = self.motion_frame(frame)
+        if small.shape != self.reference.shape:
+            return True
+        moving = cv2.absdiff(small, self.reference) > MOTION_PIXEL_DELTA
+        self.motion = float(moving.mean())
+
+        untracked = np.ones(moving.shape, dtype=bool)
+        for track in self.tracks:
+            x, y, w, h = (int(round(v * self.scale)) for v in track['rect'])
+            box = moving[max(y, 0):y + max(h, 1), max(x, 0):x + max(w, 1)]
+            if box.size and box.mean() > TRACK_MOTION_FRACTION:
+                return True
+            untracked[max(y, 0):y + max(h, 1), max(x, 0):x + max(w, 1)] = False
+        return bool(untracked.any() and moving[untracked].mean() > SCENE_MOTION_FRACTION)
+
+    def update(self, frame, faces):
+        """
+        Replace the tracks with a recognizer run's results. A face matching an
+        identified track that now comes back "Unknown" (e.g. a turned head) keeps
+        that identity for up to TRACK_KEEP_RUNS runs. Returns the tracked faces.
+        """
+        tracks = []
+        unmatched = list(self.tracks)
+        for face in faces:
+            track = dict(face, unknown_runs=0)
+            best = max(unmatched, key=lambda t: iou(t['rect'], face['rect']), default=None)
+            if best is not None and iou(best['rect'], face['rect']) >= TRACK_IOU:
+                unmatched.remove(best)
+                if not face['student_id'] and best['student_id'] and best['unknown_runs'] < TRACK_KEEP_RUNS:
+                    track.update(name=best['name'], student_id=best['student_id'],
+                                 confidence=best['confidence'], unknown_runs=best['unknown_runs'] + 1)
+            tracks.append(track)
+
+        now = time.monotonic()
+        if self.run_started is not None:
+            latency = now - self.run_started
+            self.latency = latency if not any(self.runs.values()) else \
+                (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+        reason = self.reason or 'start'
+        self.runs[reason] += 1
+
+        # Still room: back off while refreshes keep finding the same students
+        if reason == 'refresh' and self.identities(tracks) == self.identities(self.tracks):
+            self.refresh_seconds = min(self.refresh_seconds * 2, MAX_REFRESH_SECONDS)
+        else:
+            self.refresh_seconds = self.base_refresh_seconds
+
+        self.tracks = tracks
+        self.reference = self.motion_frame(frame)
+        self.last_run = self.run_started if self.run_started is not None else now
+        self.run_started = None
+        self.reason = None
+        return self.tracks
+
+    @staticmethod
+    def identities(tracks):
+        return sorted((t['student_id'] or 0, t['name']) for t in tracks)
+
+    def draw(self, frame):
+        """Draw the tracked faces (boxes and names) on a frame"""
+        for track in self.tracks:
+            x, y, w, h = (int(v) for v in track['rect'])
+            name = track['name']
+            color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
+
+            cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
+            label = f"{name} ({int(track['confidence'])}%)" if name != "Unknown" else "Unknown"
+            cv2.putText(frame, label, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+        return frame
@@ -0,0 +1,238 @@
+import json
+import os
+import re
+import sys
+import time
+import numpy as np
+
+# LBPH parameters (same as the cv2.face recognizer the models were trained with before)
+LBPH_RADIUS = 1
+LBPH_NEIGHBORS = 8
+LBPH_GRID_X = 8
+LBPH_GRID_Y = 8
+# Distances at or above this are reported as no match (label -1), like cv2's threshold
+LBPH_THRESHOLD = 500.0
+
+FORMAT_VERSION = 1
+# Max elements in one (rows x bins) distance block (16 MB per float32 temporary)
+CHI_SQUARE_BLOCK = 4 * 1024 * 1024
+
+
+def lbp_codes(gray, radius=LBPH_RADIUS, neighbors=LBPH_NEIGHBORS):
+    """
+    Extended (circular) LBP codes of a grayscale image, computed exactly like
+    OpenCV's elbp (bilinear neighbours, float32 arithmetic, border of `radius` dropped).
+    """
+    src = np.asarray(gray, dtype=np.float32)
+    rows, cols = src.shape
+    center = src[radius:rows - radius, radius:cols - radius]
+    codes = np.zeros(center.shape, dtype=np.int32)
+
+    def shifted(dy, dx):
+        return src[radius + dy:rows - radius + dy, radius + dx:cols - radius + dx]
+
+    for n in range(neighbors):
+        x = radius * np.cos(2.0 * np.pi * n / neighbors)
+        y = -radius * np.sin(2.0 * np.pi * n / neighbors)
+        fx, fy = int(np.floor(x)), int(np.floor(y))
+        cx, cy = int(np.ceil(x)), int(np.ceil(y))
+        ty, tx = np.float32(y - fy), np.float32(x - fx)
+        w1 = np.float32((1 - tx) * (1 - ty))
+        w2 = np.float32(tx * (1 - ty))
+        w3 = np.float32((1 - tx) * ty)
+        w4 = np.float32(tx * ty)
+
+        t = w1 * shifted(fy, fx) + w2 * shifted(fy, cx) + w3 * shifted(cy, fx) + w4 * shifted(cy, cx)
+        bit = (t > center) | (np.abs(t - center) < np.finfo(np.float32).eps)
+        codes += bit.astype(np.int32) << n
+    return codes
+
+
+def spatial_histogram(codes, num_patterns=2 ** LBPH_NEIGHBORS, grid_x=LBPH_GRID_X, grid_y=LBPH_GRID_Y):
+    """Concatenated per-cell pattern histograms, each normalized by the cell size"""
+    height, width = codes.shape[0] // grid_y, codes.shape[1] // grid_x
+    cells = codes[:grid_y * height, :grid_x * width].reshape(grid_y, height, grid_x, width)
+    cells = cells.transpose(0, 2, 1, 3).reshape(grid_y * grid_x, height * width)
+
+    # One bincount over all cells: offset each cell's codes into its own bin range
+    offsets = np.arange(grid_y * grid_x, dtype=np.int64)[:, None] * num_patterns
+    hist = np.bincount((cells + offsets).ravel(), minlength=grid_y * grid_x * num_patterns)
+    return (hist / (height * width)).astype(np.float32)
+
+
+def lbph_histogram(face):
+    """LBPH feature vector of one preprocessed (equalized, 200x200) face crop"""
+    return spatial_histogram(lbp_codes(face))
+
+
+def chi_square(histograms, queries):
+    """
+    OpenCV HISTCMP_CHISQR_ALT distances between every query and every row of
+    `histograms`, as a (n_queries, n_rows) matrix. Rows are processed in blocks
+    of at most CHI_SQUARE_BLOCK elements, one query at a time, with in-place
+    temporaries (a 3D queries x rows x bins broadcast is several times slower).
+    """
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    distances = np.empty((len(queries), len(histograms)), dtype=np.float32)
+    step = max(1, CHI_SQUARE_BLOCK // max(1, histograms.shape[1]))
+    for start in range(0, len(histograms), step):
+        rows = np.asarray(histograms[start:start + step])
+        for i, query in enumerate(queries):
+            diff = rows - query
+            diff *= diff
+            total = rows + query
+            # Bins are multiples of 1/cell_size, so the epsilon only affects empty bins (0/0 -> 0)
+            total += 1e-30
+            diff /= total
+            distances[i, start:start + step] = diff.sum(axis=1)
+    distances *= 2.0
+    return distances
+
+
+class LBPHModel:
+    """
+    A user's LBPH training histograms as one float32 matrix plus a label per row.
+    Stored as `<prefix>.<version>.npy` (memory-mapped on load) with a small JSON
+    manifest `<prefix>.json` holding the labels, LBPH parameters and the name of
+    the current matrix file.
+    """
+
+    def __init__(self, histograms, labels):
+        self.histograms = histograms
+        self.labels = np.asarray(labels, dtype=np.int64)
+        # Rows grouped by label, for per-student minima with one reduceat
+        self.label_order = np.argsort(self.labels, kind='stable')
+        self.student_ids, self.label_starts = np.unique(self.labels[self.label_order], return_index=True)
+
+    @classmethod
+    def from_faces(cls, faces, labels):
+        if not len(faces):
+            return cls(np.zeros((0, LBPH_GRID_X * LBPH_GRID_Y * 2 ** LBPH_NEIGHBORS), dtype=np.float32), [])
+        return cls(np.stack([lbph_histogram(face) for face in faces]), labels)
+
+    def append(self, faces, labels):
+        """New model with histograms for more faces appended (the loaded matrix is read-only)"""
+        added = LBPHModel.from_faces(faces, labels)
+        return LBPHModel(np.concatenate([self.histograms, added.histograms]),
+                         np.concatenate([self.labels, added.labels]))
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def load(cls, prefix):
+        with open(f'{prefix}.json') as f:
+            manifest = json.load(f)
+        if manifest.get('format') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported LBPH model format {manifest.get('format')}")
+        # Models saved before versioned matrix files use <prefix>.npy
+        matrix_file = manifest.get('histograms', os.path.basename(prefix) + '.npy')
+        histograms = np.load(os.path.join(os.path.dirname(prefix), matrix_file), mmap_mode='r')
+        return cls(histograms, manifest['labels'])
+
+    def save(self, prefix):
+        """
+        Write the matrix to a new file, then replace the manifest pointing at it.
+        A loaded model keeps its matrix file memory-mapped, and Windows does not
+        allow replacing a mapped file; superseded files are removed once unmapped.
+        """
+        matrix_file = f'{os.path.basename(prefix)}.{time.time_ns()}.npy'
+        matrix_path = os.path.join(os.path.dirname(prefix), matrix_file)
+        with open(matrix_path + '.tmp', 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.histograms, dtype=np.float32))
+        os.replace(matrix_path + '.tmp', matrix_path)
+
+        manifest = {
+            'format': FORMAT_VERSION,
+            'radius': LBPH_RADIUS,
+            'neighbors': LBPH_NEIGHBORS,
+            'grid_x': LBPH_GRID_X,
+            'grid_y': LBPH_GRID_Y,
+            'histograms': matrix_file,
+            'labels': [int(l) for l in self.labels],
+        }
+        with open(f'{prefix}.json.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(f'{prefix}.json.tmp', f'{prefix}.json')
+        remove_matrix_files(prefix, keep=matrix_file)
+
+    def student_distances(self, faces):
+        """
+        Nearest distance from every face to every student, all faces at once.
+        Returns (student_ids, distances) with distances shaped (n_faces, n_students).
+        """
+        probes = np.stack([lbph_histogram(face) for face in faces])
+        distances = chi_square(self.histograms, probes)
+        per_student = np.minimum.reduceat(distances[:, self.label_order], self.label_starts, axis=1)
+        return self.student_ids, per_student
+
+    def match(self, faces, k=1):
+        """
+        Top-k students for every face, nearest first.
+        Returns (labels, distances), both shaped (n_faces, k'), k' = min(k, n_students).
+        """
+        if not len(self) or not len(faces):
+            return np.zeros((len(faces), 0), dtype=np.int64), np.zeros((len(faces), 0), dtype=np.float32)
+        student_ids, distances = self.student_distances(faces)
+        k = min(k, len(student_ids))
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        top_distances = np.take_along_axis(distances, top, axis=1)
+        order = np.argsort(top_distances, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        return student_ids[top], np.take_along_axis(top_distances, order, axis=1)
+
+    def predict(self, face, threshold=LBPH_THRESHOLD):
+        """(label, distance) of the nearest training histogram; label -1 if none is closer than threshold"""
+        labels, distances = self.match([face])
+        if labels.shape[1] == 0:
+            return -1, float('inf')
+        label, distance = int(labels[0, 0]), float(distances[0, 0])
+        if distance >= threshold:
+            return -1, distance
+        return label, distance
+
+
+def matrix_files(prefix):
+    """Every matrix file saved under a model prefix (current and superseded ones)"""
+    directory, base = os.path.split(prefix)
+    if not os.path.isdir(directory or '.'):
+        return []
+    pattern = re.compile(re.escape(base) + r'(\.\d+)?\.npy')
+    return [name for name in os.listdir(directory or '.') if pattern.fullmatch(name)]
+
+
+def remove_matrix_files(prefix, keep=None):
+    """Delete a model's matrix files except `keep`; files still mapped (Windows) are left for a later save"""
+    for name in matrix_files(prefix):
+        if name != keep:
+            try:
+                os.remove(os.path.join(os.path.dirname(prefix), name))
+            except OSError:
+                pass
+
+
+def convert_yml_model(yml_path, prefix):
+    """Convert a cv2 LBPH .yml model to the .npy/.json format; returns the loaded model"""
+    import cv2
+    recognizer = cv2.face.LBPHFaceRecognizer_create(
+        radius=LBPH_RADIUS, neighbors=LBPH_NEIGHBORS, grid_x=LBPH_GRID_X, grid_y=LBPH_GRID_Y
+    )
+    recognizer.read(yml_path)
+    histograms = recognizer.getHistograms()
+    if histograms:
+        matrix = np.concatenate([np.asarray(h, dtype=np.float32).reshape(1, -1) for h in histograms])
+    else:
+        matrix = np.zeros((0, LBPH_GRID_X * LBPH_GRID_Y * 2 ** LBPH_NEIGHBORS), dtype=np.float32)
+    model = LBPHModel(matrix, np.asarray(recognizer.getLabels()).ravel())
+    model.save(prefix)
+    return LBPHModel.load(prefix)
+
+
+if __name__ == '__main__':
+    # Convert every per-user .yml model in a directory: python lbph_model.py [models_dir]
+    models_dir = sys.argv[1] if len(sys.argv) > 1 else 'models'
+    for name in sorted(os.listdir(models_dir)):
+        if name.startswith('user_') and name.endswith('.yml'):
+            user_id = name[len('user_'):-len('.yml')]
+            model = convert_yml_model(os.path.join(models_dir, name), os.path.join(models_dir, f'lbph_{user_id}'))
+            print(f"✓ Converted {name}: {len(model)} histograms")
@@ -1,53 +1,395 @@
 import cv2
+import hashlib
+import multiprocessing
 import numpy as np
 import os
 import pickle
 import sqlite3
+import time
 from pathlib import Path
+from database import get_student_owner, get_gallery_version, bump_gallery_version
+from lbph_model import LBPHModel, convert_yml_model, LBPH_THRESHOLD
+
+# Processes used by train_user_model (1 = train in this process)
+TRAIN_WORKERS = int(os.environ.get('TRAIN_WORKERS', '1'))
+# Seconds between checks whether another process saved a newer model
+MODEL_CHECK_SECONDS = 5.0
+# Nearest students (with LBPH distances) reported per recognized face
+CANDIDATES_K = 3
+# Face detector: 'haar' (cascade, default) or 'yunet' (cv2.FaceDetectorYN, ONNX on CPU)
+FACE_DETECTOR = os.environ.get('FACE_DETECTOR', 'haar').lower()
+YUNET_MODEL_PATH = os.environ.get('YUNET_MODEL', 'models/face_detection_yunet_2023mar.onnx')
+# The model is fetched at build time (python opencv_face_recognition.py --fetch-yunet) from a
+# pinned opencv_zoo commit and only installed if its SHA-256 matches; both must be set to fetch
+YUNET_MODEL_COMMIT = os.environ.get('YUNET_MODEL_COMMIT', '')
+YUNET_MODEL_SHA256 = os.environ.get('YUNET_MODEL_SHA256', '')
+YUNET_MODEL_URL = ('https://github.com/opencv/opencv_zoo/raw/{commit}/models/'
+                   'face_detection_yunet/face_detection_yunet_2023mar.onnx')
+# Seconds before a stalled model download is given up
+YUNET_DOWNLOAD_TIMEOUT = 30
+YUNET_SCORE_THRESHOLD = 0.8
+# Smallest face (pixels) kept by either detector
+MIN_FACE_SIZE = 30
+# Smallest face (pixels at full frame resolution) recognize_faces must find; frames are
+# downscaled for detection as far as this allows
+DETECT_MIN_FACE = int(os.environ.get('DETECT_MIN_FACE', '60'))
+# Frames are never downscaled below this width for detection
+DETECT_MIN_WIDTH = 640
+
+# Model instance owned by a training worker process
+worker_recognizer = None
+
+
+def init_training_worker():
+    """Pool initializer: give this worker its own detector, single-threaded"""
+    global worker_recognizer
+    cv2.setNumThreads(1)
+    worker_recognizer = OpenCVFaceRecognition()
+
+
+def extract_student_faces(task):
+    """Pool task: face crops of one student's images using the worker's own detector"""
+    student_id, image_files = task
+    return student_id, worker_recognizer.extract_faces(image_files)
+
+
+class HaarDetector:
+    """Haar cascade detectMultiScale on the equalized grayscale image"""
+    name = 'haar'
 
-class OpenCVFaceRecognition:
-    """Face recognition using OpenCV's LBPH (Local Binary Patterns Histograms)"""
-    
     def __init__(self):
-        self.face_cascade = cv2.CascadeClassifier(
+        self.cascade = cv2.CascadeClassifier(
             cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
         )
+
+    def detect(self, image, gray, fast=False):
+        """Face boxes (x, y, w, h); fast uses a coarser scale step (1.2 instead of 1.1)"""
+        detected = self.cascade.detectMultiScale(
+            gray, scaleFactor=1.2 if fast else 1.1, minNeighbors=5, minSize=(MIN_FACE_SIZE, MIN_FACE_SIZE)
+        )
+        return [tuple(int(v) for v in rect) for rect in detected]
+
+
+def fetch_yunet_model(model_path=YUNET_MODEL_PATH):
+    """
+    Download the YuNet model from the pinned opencv_zoo commit, verify its
+    SHA-256 and install it at model_path (meant for build time, not app start).
+    """
+    if not (YUNET_MODEL_COMMIT and YUNET_MODEL_SHA256):
+        raise RuntimeError("YUNET_MODEL_COMMIT and YUNET_MODEL_SHA256 must be set to fetch the YuNet model")
+    import urllib.request
+    url = YUNET_MODEL_URL.format(commit=YUNET_MODEL_COMMIT)
+    print(f"[INFO] Downloading YuNet model to {model_path}")
+    with urllib.request.urlopen(url, timeout=YUNET_DOWNLOAD_TIMEOUT) as response:
+        data = response.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if digest != YUNET_MODEL_SHA256.lower():
+        raise RuntimeError(f"YuNet model checksum mismatch: got {digest}")
+
+    os.makedirs(os.path.dirname(model_path) or '.', exist_ok=True)
+    with open(model_path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(model_path + '.tmp', model_path)
+    return model_path
+
+
+class YuNetDetector:
+    """
+    YuNet CNN detector (cv2.FaceDetectorYN) on the color image. Scale-invariant,
+    so there is no scale step to tune. The ONNX model (~230 KB) must already be
+    at YUNET_MODEL_PATH (see fetch_yunet_model); it is never downloaded at
+    app start, and create_detector falls back to Haar without it.
+    """
+    name = 'yunet'
+
+    def __init__(self, model_path=YUNET_MODEL_PATH, score_threshold=YUNET_SCORE_THRESHOLD):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"{model_path} not found (python opencv_face_recognition.py --fetch-yunet)")
+        if YUNET_MODEL_SHA256:
+            with open(model_path, 'rb') as f:
+                if hashlib.sha256(f.read()).hexdigest() != YUNET_MODEL_SHA256.lower():
+                    raise ValueError(f"{model_path} does not match YUNET_MODEL_SHA256")
+        self.detector = cv2.FaceDetectorYN.create(model_path, "", (320, 320), score_threshold, 0.3, 5000)
+
+    def detect(self, image, gray, fast=False):
+        """Face boxes (x, y, w, h), clipped to the image"""
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        height, width = image.shape[:2]
+        self.detector.setInputSize((width, height))
+        _, detected = self.detector.detect(image)
+        if detected is None:
+            return []
+
+        rects = []
+        for face in detected:
+            x, y, w, h = (int(round(v)) for v in face[:4])
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + w, width), min(y + h, height)
+            if x1 - x0 >= MIN_FACE_SIZE and y1 - y0 >= MIN_FACE_SIZE:
+                rects.append((x0, y0, x1 - x0, y1 - y0))
+        return rects
+
+
+DETECTORS = {'haar': HaarDetector, 'yunet': YuNetDetector}
+
+
+def detection_scale(width, min_face=DETECT_MIN_FACE):
+    """
+    Factor (<= 1) to shrink a frame by before detection: faces of min_face pixels
+    still reach the detector's MIN_FACE_SIZE, and the frame stays at least
+    DETECT_MIN_WIDTH wide, so small frames are detected as they are.
+    """
+    scale = max(MIN_FACE_SIZE / max(min_face, 1), DETECT_MIN_WIDTH / max(width, 1))
+    return min(1.0, scale)
+
+
+def create_detector(name=None):
+    """Detector by name (default FACE_DETECTOR); falls back to Haar if YuNet cannot be loaded"""
+    name = (name or FACE_DETECTOR).lower()
+    if name not in DETECTORS:
+        print(f"[WARN] Unknown face detector '{name}', using haar")
+        name = 'haar'
+    try:
+        return DETECTORS[name]()
+    except Exception as e:
+        if name == 'haar':
+            raise
+        print(f"[WARN] {name} detector unavailable ({e}), using haar")
+        return HaarDetector()
+
+
+class OpenCVFaceRecognition:
+    """
+    Face recognition using LBPH (Local Binary Patterns Histograms).
+    Per-user histograms are stored as models/lbph_{id}.<version>.npy + .json (see lbph_model.py)
+    and memory-mapped on load; older models/user_{id}.yml files are converted once.
+    Faces are found by a pluggable detector (HaarDetector or YuNetDetector, see
+    FACE_DETECTOR); switching detectors makes the next training a full rebuild.
+    """
+    
+    def __init__(self, detector=None):
+        self.detector = create_detector(detector)
         
-        # Cache for user models: {user_id: (recognizer, student_labels)}
+        # Cache for user models: {user_id: (LBPHModel, student_labels)}
         self.active_models = {}
+        # {user_id: (model version the cache reflects, last check time)}
+        self.model_versions = {}
         
     def get_user_model(self, user_id):
         """Get or load model for specific user"""
-        if user_id in self.active_models:
+        if user_id in self.active_models and not self.model_changed(user_id):
             return self.active_models[user_id]
-            
-        model_path = f'models/user_{user_id}.yml'
+        self.active_models.pop(user_id, None)
+
+        version = get_gallery_version(user_id)
+        model, labels = self.load_model_files(user_id)
+        if model is not None:
+            self.active_models[user_id] = (model, labels)
+            self.model_versions[user_id] = (version, time.monotonic())
+            print(f"✓ Loaded model for User {user_id} ({len(labels)} students)")
+        return model, labels
+
+    def load_model_files(self, user_id):
+        """Memory-map a user's saved LBPH histograms and read its labels, or (None, None)"""
+        model_prefix = f'models/lbph_{user_id}'
+        yml_path = f'models/user_{user_id}.yml'
         labels_path = f'models/labels_{user_id}.pkl'
         
-        if os.path.exists(model_path) and os.path.exists(labels_path):
+        if not os.path.exists(labels_path):
+            return None, None
+        try:
+            if os.path.exists(model_prefix + '.json'):
+                model = LBPHModel.load(model_prefix)
+            elif os.path.exists(yml_path):
+                # One-time conversion of the old YAML model
+                print(f"[INFO] Converting {yml_path} to binary LBPH format")
+                model = convert_yml_model(yml_path, model_prefix)
+                os.remove(yml_path)
+            else:
+                return None, None
+            with open(labels_path, 'rb') as f:
+                labels = pickle.load(f)
+            return model, labels
+        except Exception as e:
+            print(f"⚠ Error loading model for User {user_id}: {e}")
+        return None, None
+
+    def save_model_files(self, user_id, model, student_labels):
+        """Write model and labels via temp files so readers never see half a file"""
+        os.makedirs('models', exist_ok=True)
+        labels_path = f'models/labels_{user_id}.pkl'
+        if model is not None:
+            model.save(f'models/lbph_{user_id}')
+        with open(labels_path + '.tmp', 'wb') as f:
+            pickle.dump(student_labels, f)
+        os.replace(labels_path + '.tmp', labels_path)
+
+    def model_changed(self, user_id):
+        """True if another process saved a newer model (checked every few seconds)"""
+        version, checked_at = self.model_versions.get(user_id, (None, 0.0))
+        now = time.monotonic()
+        if now - checked_at < MODEL_CHECK_SECONDS:
+            return False
+        try:
+            current = get_gallery_version(user_id)
+        except Exception as e:
+            print(f"⚠ Could not check model version: {e}")
+            return False
+        self.model_versions[user_id] = (version, now)
+        return current != version
+
+    def add_student_images(self, student_id, student_images_dir='static/student_images'):
+        """
+        Append a student's new images to the owner's saved model: only this
+        student's unseen images are processed and their histograms appended.
+        Returns (False, message) when that is not possible (no saved model yet,
+        or images of the student were removed/replaced, which needs a full rebuild).
+        """
+        owner = get_student_owner(student_id)
+        if not owner or not owner[2]:
+            return False, "Student not found."
+        user_id, student_name, _ = owner
+        model, labels = self.get_user_model(user_id)
+        if model is None:
+            return False, "No trained model yet."
+
+        images = self.student_image_hashes(student_images_dir, student_id, student_name)
+        trained = labels.get(student_id)
+        if trained is not None and (trained.get('images') is None or not trained['images'] <= set(images)
+                                    or trained.get('detector', 'haar') != self.detector.name):
+            return False, "Images changed, full retraining needed."
+
+        done_images = trained['images'] if trained else set()
+        new_images = {h: path for h, path in images.items() if h not in done_images}
+        if trained is not None and not new_images:
+            return True, "Model already up to date."
+        faces = self.extract_faces(list(new_images.values()))
+        if trained is None:
+            if not faces:
+                return False, "No faces found in the images."
+            conn = sqlite3.connect('classroom.db')
+            roll_number = conn.execute('SELECT roll_number FROM students WHERE id = ?', (student_id,)).fetchone()[0]
+            conn.close()
+            trained = {'name': student_name, 'roll_number': roll_number, 'face_count': 0, 'images': set(),
+                       'detector': self.detector.name}
+
+        labels = dict(labels)
+        labels[student_id] = dict(trained, name=student_name, face_count=trained['face_count'] + len(faces),
+                                  images=trained['images'] | set(new_images))
+        if faces:
+            model = model.append(faces, [student_id] * len(faces))
+        self.save_model_files(user_id, model if faces else None, labels)
+        self.active_models[user_id] = (model, labels)
+        self.model_versions[user_id] = (bump_gallery_version(user_id), time.monotonic())
+        print(f"  ✓ Added {student_name}: {len(faces)} faces ({len(new_images)} new images)")
+        return True, f"{len(faces)} faces added."
+
+    def sync_student(self, student_id, previous_user_id=None):
+        """
+        Apply one student's DB change to the cached labels without retraining.
+        A deleted or moved-away student is dropped from the labels, so its
+        histograms can no longer match; they are purged by the full rebuild
+        the next train_user_model run performs. Renames only touch metadata;
+        a student moved in from another owner gets its faces appended.
+        Returns False if the change needs a full training run.
+        """
+        owner = get_student_owner(student_id)
+        user_ids = {previous_user_id} - {None}
+        if owner:
+            user_ids.add(owner[0])
+
+        applied = True
+        for user_id in user_ids:
+            model, labels = self.get_user_model(user_id)
+            if model is None:
+                continue
+            if student_id not in labels:
+                if owner and owner[0] == user_id and owner[2]:
+                    # Moved in from another class owner: append its faces
+                    applied = self.add_student_images(student_id)[0] and applied
+                continue
+            labels = dict(labels)
+            if owner and owner[0] == user_id and owner[2]:
+                labels[student_id] = dict(labels[student_id], name=owner[1])
+            else:
+                labels.pop(student_id)
+            self.save_model_files(user_id, None, labels)
+            self.active_models[user_id] = (model, labels)
+            self.model_versions[user_id] = (bump_gallery_version(user_id), time.monotonic())
+        return applied
+
+    def find_student_folder(self, student_images_dir, student_id, student_name):
+        """Image folder of a student ({id}_{name}, or the legacy {name}), or None"""
+        from werkzeug.utils import secure_filename
+        # Use secure_filename to match upload logic
+        secure_name = secure_filename(student_name.lower().replace(' ', '_'))
+        for folder in (f"{student_id}_{secure_name}", secure_name):
+            path = os.path.join(student_images_dir, folder)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def student_image_hashes(self, student_images_dir, student_id, student_name):
+        """{content hash: image path} of a student's enrollment images ({} if there are none)"""
+        student_folder = self.find_student_folder(student_images_dir, student_id, student_name)
+        if not student_folder:
+            return {}
+        image_files = []
+        for ext in ['*.jpg', '*.jpeg', '*.png']:
+            image_files.extend(list(Path(student_folder).glob(ext)))
+
+        images = {}
+        for img_path in image_files:
+            try:
+                images[hashlib.sha1(img_path.read_bytes()).hexdigest()] = img_path
+            except Exception as e:
+                print(f"✗ Error reading {img_path.name}: {e}")
+        return images
+
+    def extract_faces(self, image_files):
+        """Equalized 200x200 grayscale crops of every face found in the images"""
+        faces = []
+        for img_path in image_files:
             try:
-                recognizer = cv2.face.LBPHFaceRecognizer_create(
-                    radius=1, neighbors=8, grid_x=8, grid_y=8, threshold=500.0
-                )
-                recognizer.read(model_path)
-                with open(labels_path, 'rb') as f:
-                    labels = pickle.load(f)
+                img = cv2.imread(str(img_path))
+                if img is None: continue
+                
+                # Optimization: Resize huge images before processing
+                height, width = img.shape[:2]
+                if width > 800:
+                    scale = 800 / width
+                    img = cv2.resize(img, (0,0), fx=scale, fy=scale)
+                
+                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+                gray = cv2.equalizeHist(gray)
+                
+                # Detect faces for cropping (coarser Haar scale step for speed)
+                detected = self.detector.detect(img, gray, fast=True)
                 
-                self.active_models[user_id] = (recognizer, labels)
-                print(f"✓ Loaded model for User {user_id} ({len(labels)} students)")
-                return recognizer, labels
+                for (x, y, w, h) in detected:
+                    # Resize face to a consistent size for training
+                    face_roi = gray[y:y+h, x:x+w]
+                    faces.append(cv2.resize(face_roi, (200, 200)))
             except Exception as e:
-                print(f"⚠ Error loading model for User {user_id}: {e}")
-                return None, None
-        return None, None
+                print(f"✗ Error processing {Path(img_path).name}: {e}")
+        return faces
 
-    def train_user_model(self, user_id, student_images_dir='static/student_images'):
-        """Train face recognition for a specific user's students"""
+    def train_user_model(self, user_id, student_images_dir='static/student_images', workers=None, progress=None,
+                         incremental=True):
+        """
+        Train face recognition for a specific user's students.
+        Incrementally by default: only images not yet in the saved model are
+        processed and their histograms appended to the model. The model is rebuilt
+        from scratch when a trained student is gone or one of its images was
+        removed or replaced, or with incremental=False.
+        With workers > 1 (default TRAIN_WORKERS) face extraction runs in a
+        process pool, one student folder per task.
+        progress(student_id, name, done, total) is called as each student's images are handled.
+        """
         print("=" * 60)
         print(f"🎓 Starting Training for User {user_id}")
         
-        from werkzeug.utils import secure_filename
-        
         # Get user's students
         try:
             conn = sqlite3.connect('classroom.db')
@@ -64,7 +406,7 @@ class OpenCVFaceRecognition:
             conn.close()
         except Exception as e:
             print(f"✗ Database error: {e}")
-            return False
+            return False, "Database error"
             
         if not students:
             print("✗ No active students found for this user")
@@ -76,132 +418,182 @@ class OpenCVFaceRecognition:
         labels = []
         student_labels = {}
         total_images = 0
+        tasks = [] # (student_id, image_files)
+        student_info = {}
+        student_images = {} # {student_id: {content hash: image path}}
         
         for student_id, student_name, roll_number in students:
-            # Use secure_filename to match upload logic
-            secure_name = secure_filename(student_name.lower().replace(' ', '_'))
-            
-            # Try new format: {id}_{name}
-            folder_new = f"{student_id}_{secure_name}"
-            path_new = os.path.join(student_images_dir, folder_new)
-            
-            # Try legacy format: {name}
-            folder_legacy = secure_name
-            path_legacy = os.path.join(student_images_dir, folder_legacy)
-            
-            student_folder = None
-            if os.path.exists(path_new):
-                student_folder = path_new
-            elif os.path.exists(path_legacy):
-                student_folder = path_legacy
-            
-            if not student_folder:
-                # Silently skip if no folder found (might be a student with no photos yet)
-                print(f"⚠ No folder for {student_name}")
-                continue
-                
-            image_files = []
-            for ext in ['*.jpg', '*.jpeg', '*.png']:
-                image_files.extend(list(Path(student_folder).glob(ext)))
-                
-            if not image_files:
+            images = self.student_image_hashes(student_images_dir, student_id, student_name)
+            if not images:
+                # Silently skip if no images found (might be a student with no photos yet)
+                print(f"⚠ No images for {student_name}")
                 continue
+            student_images[student_id] = images
+            student_info[student_id] = (student_name, roll_number)
 
-            count = 0
-            for img_path in image_files:
-                try:
-                    img = cv2.imread(str(img_path))
-                    if img is None: continue
-                    
-                    # Optimization: Resize huge images before processing
-                    height, width = img.shape[:2]
-                    if width > 800:
-                        scale = 800 / width
-                        img = cv2.resize(img, (0,0), fx=scale, fy=scale)
-                    
-                    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                    gray = cv2.equalizeHist(gray)
-                    
-                    # Detect faces for cropping
-                    # Increased scaleFactor to 1.2 for speed
-                    detected = self.face_cascade.detectMultiScale(
-                        gray, scaleFactor=1.2, minNeighbors=5, minSize=(30, 30)
-                    )
-                    
-                    for (x, y, w, h) in detected:
-                        # Resize face to a consistent size for training
-                        face_roi = gray[y:y+h, x:x+w]
-                        face_roi = cv2.resize(face_roi, (200, 200))
-                        faces.append(face_roi)
-                        labels.append(student_id)
-                        count += 1
-                        total_images += 1
-                except Exception as e:
-                    print(f"✗ Error processing {img_path.name}: {e}")
-            
+        # Incremental only if everything in the saved model is still current
+        model, old_labels = self.load_model_files(user_id) if incremental else (None, None)
+        if model is not None:
+            trained_ids = set(int(l) for l in np.unique(model.labels))
+            for student_id in trained_ids:
+                trained = old_labels.get(student_id, {})
+                trained_images = trained.get('images')
+                # Crops from another detector are framed differently; don't mix them
+                if (student_id not in student_images or trained_images is None
+                        or not trained_images <= set(student_images[student_id])
+                        or trained.get('detector', 'haar') != self.detector.name):
+                    print(f"  [INFO] Student {student_id} removed or changed, rebuilding model")
+                    model, old_labels = None, None
+                    break
+        if old_labels is None:
+            old_labels = {}
+
+        for student_id, images in student_images.items():
+            done_images = old_labels.get(student_id, {}).get('images', set())
+            new_files = [path for h, path in images.items() if h not in done_images]
+            if new_files:
+                tasks.append((student_id, new_files))
+            if progress:
+                progress(student_id, student_info[student_id][0], len(images) - len(new_files), len(images))
+
+        if workers is None:
+            workers = TRAIN_WORKERS
+        workers = min(workers, len(tasks))
+
+        image_counts = {student_id: len(images) for student_id, images in student_images.items()}
+        results = []
+        if workers > 1:
+            # One student folder per task; every worker process has its own detector
+            print(f"  [INFO] Processing {len(tasks)} students on {workers} processes")
+            # Spawned, not forked: the server process runs camera, training and ONNX threads
+            # whose locks a forked child could inherit held
+            with multiprocessing.get_context('spawn').Pool(workers, initializer=init_training_worker) as pool:
+                for student_id, student_faces in pool.imap_unordered(extract_student_faces, tasks):
+                    results.append((student_id, student_faces))
+                    if progress:
+                        progress(student_id, student_info[student_id][0], image_counts[student_id], image_counts[student_id])
+        else:
+            for student_id, image_files in tasks:
+                results.append((student_id, self.extract_faces(image_files)))
+                if progress:
+                    progress(student_id, student_info[student_id][0], image_counts[student_id], image_counts[student_id])
+
+        # Students already in the model keep their entry (metadata refreshed)
+        for student_id, info in old_labels.items():
+            if student_id in student_info:
+                student_name, roll_number = student_info[student_id]
+                student_labels[student_id] = dict(info, name=student_name, roll_number=roll_number)
+
+        processed = {student_id: set(image_files) for student_id, image_files in tasks}
+        for student_id, student_faces in results:
+            count = len(student_faces)
+            faces.extend(student_faces)
+            labels.extend([student_id] * count)
+            total_images += count
+
+            # Remember every processed image (also those without a face) so it is not redone
+            hashes = {h for h, path in student_images[student_id].items() if path in processed[student_id]}
+            entry = student_labels.get(student_id)
+            if entry is None:
+                if count == 0:
+                    continue
+                student_name, roll_number = student_info[student_id]
+                entry = {'name': student_name, 'roll_number': roll_number, 'face_count': 0, 'images': set(),
+                         'detector': self.detector.name}
+            entry = dict(entry, face_count=entry['face_count'] + count, images=entry['images'] | hashes)
+            student_labels[student_id] = entry
             if count > 0:
-                student_labels[student_id] = {
-                    'name': student_name, 
-                    'roll_number': roll_number,
-                    'face_count': count
-                }
-                print(f"  ✓ Added {student_name}: {count} faces")
-
-        if not faces:
+                print(f"  ✓ Added {entry['name']}: {count} faces")
+
+        if not student_labels:
             print("✗ No faces found for training")
             return False, "No valid faces found in images. Please clear and re-upload images."
-            
-        # Train
-        recognizer = cv2.face.LBPHFaceRecognizer_create(
-            radius=1, neighbors=8, grid_x=8, grid_y=8, threshold=500.0
-        )
-        recognizer.train(faces, np.array(labels))
+
+        if model is None:
+            # Full (re)build
+            model = LBPHModel.from_faces(faces, labels)
+            message = "Training completed successfully!"
+        elif faces:
+            # Append histograms for the new images only
+            model = model.append(faces, labels)
+            message = f"Model updated with {total_images} new faces."
+        else:
+            message = "Model already up to date."
         
         # Save
-        os.makedirs('models', exist_ok=True)
         try:
-            recognizer.write(f'models/user_{user_id}.yml')
-            with open(f'models/labels_{user_id}.pkl', 'wb') as f:
-                pickle.dump(student_labels, f)
+            self.save_model_files(user_id, model, student_labels)
         except Exception as e:
              return False, f"Error saving model: {e}"
             
-        # Update cache
-        self.active_models[user_id] = (recognizer, student_labels)
-        print(f"✓ Training Complete for User {user_id}")
-        return True, "Training completed successfully!"
+        # Update cache; other processes reload on their next version check
+        self.active_models[user_id] = (model, student_labels)
+        self.model_versions[user_id] = (bump_gallery_version(user_id), time.monotonic())
+        print(f"✓ Training Complete for User {user_id}: {message}")
+        return True, message
+
+    def detect_scaled(self, frame, gray, min_face=DETECT_MIN_FACE):
+        """
+        Detect on a downscaled copy of the frame (see detection_scale) and map the
+        boxes back to full-resolution coordinates, clipped to the frame.
+        """
+        height, width = gray.shape[:2]
+        scale = detection_scale(width, min_face)
+        if scale >= 1.0:
+            return self.detector.detect(frame, gray)
+
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        small_frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        small_gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+        faces = []
+        for (x, y, w, h) in self.detector.detect(small_frame, small_gray):
+            x0, y0 = int(x / scale), int(y / scale)
+            x1, y1 = min(width, int(round((x + w) / scale))), min(height, int(round((y + h) / scale)))
+            faces.append((x0, y0, x1 - x0, y1 - y0))
+        return faces
 
     def recognize_faces(self, frame, user_id, confidence_threshold=100):
         """Recognize faces in frame using user's model"""
-        recognizer, student_labels = self.get_user_model(user_id)
+        model, student_labels = self.get_user_model(user_id)
         
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         gray = cv2.equalizeHist(gray)
         
-        faces = self.face_cascade.detectMultiScale(
-            gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30)
-        )
+        faces = self.detect_scaled(frame, gray)
         
         if len(faces) > 0:
-            print(f"DEBUG: Detected {len(faces)} faces (Haar)")
+            print(f"DEBUG: Detected {len(faces)} faces ({self.detector.name})")
 
         results = []
         for (x, y, w, h) in faces:
-            result = {
+            results.append({
                 'rect': (x, y, w, h),
                 'name': "Unknown",
                 'student_id': None,
                 'confidence': 0.0,
-                'raw_confidence': 0.0
-            }
-            
-            if recognizer:
-                try:
-                    roi = gray[y:y+h, x:x+w]
-                    # Must resize to match training size (200x200)
-                    roi = cv2.resize(roi, (200, 200))
-                    
-                    label_id, conf = recognizer.predict(roi)
+                'raw_confidence': 0.0,
+                'candidates': []
+            })
+
+        if model and len(faces) > 0:
+            try:
+                # Crops come from the full-resolution gray frame; resized to training size (200x200)
+                rois = [cv2.resize(gray[y:y+h, x:x+w], (200, 200)) for (x, y, w, h) in faces]
+
+                # Every face scored against every histogram at once; per-student nearest distances
+                top_labels, top_distances = model.match(rois, k=CANDIDATES_K)
+
+                for result, face_labels, face_distances in zip(results, top_labels, top_distances):
+                    result['candidates'] = [
+                        {'student_id': int(l), 'name': student_labels.get(int(l), {}).get('name', "Unknown"),
+                         'distance': float(d)}
+                        for l, d in zip(face_labels, face_distances) if int(l) in student_labels
+                    ]
+                    if not result['candidates']:
+                        continue
+                    label_id = result['candidates'][0]['student_id']
+                    conf = result['candidates'][0]['distance']
                     
                     # DEBUG LOG
                     print(f"DEBUG: Predicted ID: {label_id}, Conf: {conf}")
@@ -210,17 +602,13 @@ class OpenCVFaceRecognition:
                     # Convert to score (0-100)
                     score = max(0, 100 - conf)
                     
-                    if conf < confidence_threshold:
-                         if label_id in student_labels:
-                            info = student_labels[label_id]
-                            result['name'] = info['name']
-                            result['student_id'] = label_id
-                            result['confidence'] = score
-                            result['raw_confidence'] = conf
-                except Exception as e:
-                    print(f"Prediction Error: {e}")
-            
-            results.append(result)
+                    if conf < confidence_threshold and conf < LBPH_THRESHOLD:
+                        result['name'] = result['candidates'][0]['name']
+                        result['student_id'] = label_id
+                        result['confidence'] = score
+                        result['raw_confidence'] = conf
+            except Exception as e:
+                print(f"Prediction Error: {e}")
             
         return results
 
@@ -239,3 +627,10 @@ class OpenCVFaceRecognition:
             cv2.putText(frame, label, (x, y-10), 
                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
         return frame
+
+
+if __name__ == '__main__':
+    # Build step: python opencv_face_recognition.py --fetch-yunet
+    import sys
+    if '--fetch-yunet' in sys.argv[1:]:
+        print(f"✓ YuNet model installed at {fetch_yunet_model()}")
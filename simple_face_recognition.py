@@ -6,11 +6,17 @@ from PIL import Image
 import sqlite3
 from datetime import datetime
 
+# Maximum correlation distance (1 - HISTCMP_CORREL) accepted as a match
+MATCH_THRESHOLD = 0.3
+
 class SimpleFaceRecognition:
     def __init__(self):
         self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
         self.known_faces = {}
         self.face_labels = {}
+        # Known histograms as one matrix: mean-centered, unit-length rows (see build_known_matrix)
+        self.known_matrix = np.zeros((0, 256), dtype=np.float32)
+        self.known_ids = []
         self.load_known_faces()
     
     def load_known_faces(self):
@@ -42,11 +48,42 @@ class SimpleFaceRecognition:
                         self.face_labels[student_id] = name
             
             conn.close()
+            self.build_known_matrix()
             print(f"Loaded {len(self.known_faces)} known faces")
             
         except Exception as e:
             print(f"Error loading faces: {e}")
     
+    @staticmethod
+    def center_rows(histograms):
+        """Mean-center and L2-normalize rows, so a dot product is the HISTCMP_CORREL correlation"""
+        centered = histograms - histograms.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(centered, axis=1, keepdims=True)
+        return centered / np.maximum(norms, 1e-12)
+
+    def build_known_matrix(self):
+        """Stack the known (averaged) histograms into known_matrix, one row per student"""
+        self.known_ids = list(self.known_faces)
+        if self.known_ids:
+            histograms = np.stack([self.known_faces[sid] for sid in self.known_ids]).astype(np.float32)
+            self.known_matrix = self.center_rows(histograms)
+        else:
+            self.known_matrix = np.zeros((0, 256), dtype=np.float32)
+
+    def match_histograms(self, histograms):
+        """
+        Best known student for every face histogram at once.
+        Returns a name (or None below the threshold) per histogram.
+        """
+        if not len(histograms) or not self.known_ids:
+            return [None] * len(histograms)
+        # Correlation of every face with every student in one product
+        correlation = self.center_rows(np.stack(histograms).astype(np.float32)) @ self.known_matrix.T
+        best = np.argmax(correlation, axis=1)
+        distances = 1 - correlation[np.arange(len(best)), best]
+        return [self.face_labels[self.known_ids[b]] if d < MATCH_THRESHOLD else None
+                for b, d in zip(best, distances)]
+
     def extract_face_encoding(self, image_path):
         """Extract simple face encoding using histogram features"""
         try:
@@ -89,6 +126,7 @@ class SimpleFaceRecognition:
             
             recognized_names = []
             
+            histograms = []
             for (x, y, w, h) in faces:
                 # Extract face
                 face_roi = gray[y:y+h, x:x+w]
@@ -96,23 +134,12 @@ class SimpleFaceRecognition:
                 
                 # Create encoding
                 hist = cv2.calcHist([face_roi], [0], None, [256], [0, 256])
-                hist = cv2.normalize(hist, hist).flatten()
-                
-                # Compare with known faces
-                best_match = None
-                best_distance = float('inf')
-                
-                for student_id, known_encoding in self.known_faces.items():
-                    # Calculate correlation distance
-                    distance = cv2.compareHist(hist, known_encoding, cv2.HISTCMP_CORREL)
-                    
-                    # Convert correlation to distance (higher correlation = lower distance)
-                    distance = 1 - distance
-                    
-                    if distance < best_distance and distance < 0.3:  # Threshold
-                        best_distance = distance
-                        best_match = self.face_labels[student_id]
-                
+                histograms.append(cv2.normalize(hist, hist).flatten())
+            
+            # Compare all faces with all known faces at once
+            matches = self.match_histograms(histograms)
+            
+            for (x, y, w, h), best_match in zip(faces, matches):
                 if best_match:
                     recognized_names.append(best_match)
                     # Draw rectangle and name
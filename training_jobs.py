@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from database import create_training_job, update_training_job, get_training_job
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no flock, only the in-process coalescing applies
+    fcntl = None
+
+# Seconds between progress writes while a student is still being processed
+PROGRESS_WRITE_INTERVAL = 1.0
+# A queued/running job not updated for this long is treated as dead (e.g. worker restarted)
+STALE_JOB_MINUTES = 15
+# Seconds before retrying a job whose user is being trained by another process
+LOCK_RETRY_SECONDS = 2.0
+
+# One training at a time per process; jobs queue behind each other
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='training')
+submit_lock = threading.Lock()
+# Ids of jobs waiting in this process's executor; kept fresh while the run ahead of them progresses
+waiting_jobs = set()
+waiting_lock = threading.Lock()
+
+
+def is_job_active(job):
+    """True if a job is queued/running and has been updated recently"""
+    if not job or job['status'] not in ('queued', 'running'):
+        return False
+    updated_at = datetime.strptime(job['updated_at'], '%Y-%m-%d %H:%M:%S')
+    # CURRENT_TIMESTAMP is UTC
+    return datetime.utcnow() - updated_at < timedelta(minutes=STALE_JOB_MINUTES)
+
+
+def acquire_user_lock(user_id, kind='train', blocking=False):
+    """
+    Per-user file lock shared by all processes (gunicorn workers).
+    Returns the open lock file, or None if it is held elsewhere and blocking is False.
+    """
+    os.makedirs('models', exist_ok=True)
+    lock_file = open(f'models/{kind}_{user_id}.lock', 'w')
+    if fcntl is None:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return lock_file
+    except OSError:
+        lock_file.close()
+        return None
+
+
+def set_waiting(job_id, waiting=True):
+    with waiting_lock:
+        if waiting:
+            waiting_jobs.add(job_id)
+        else:
+            waiting_jobs.discard(job_id)
+
+
+def touch_waiting_jobs():
+    """Refresh updated_at of the jobs queued behind the running one, so they do not look stale"""
+    with waiting_lock:
+        job_ids = list(waiting_jobs)
+    for job_id in job_ids:
+        update_training_job(job_id)
+
+
+def release_user_lock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+
+def submit_training(recognizer, user_id, student_images_dir):
+    """
+    Queue a background training run for a user, coalescing duplicates.
+    A queued job is joined as is; while a job is running exactly one
+    follow-up run is queued behind it (it picks up changes made meanwhile).
+    Returns (job_id, created).
+    """
+    with submit_lock:
+        # Check-and-create must not interleave with another worker doing the same
+        lock_file = acquire_user_lock(user_id, kind='submit', blocking=True)
+        try:
+            job = get_training_job(user_id)
+            if is_job_active(job) and job['status'] == 'queued':
+                return job['id'], False
+
+            job_id = create_training_job(user_id)
+        finally:
+            release_user_lock(lock_file)
+
+        set_waiting(job_id)
+        executor.submit(run_training_job, recognizer, job_id, user_id, student_images_dir)
+        return job_id, True
+
+
+def run_training_job(recognizer, job_id, user_id, student_images_dir):
+    """Run train_user_model and record its progress and result on the job row"""
+    set_waiting(job_id, False)
+    lock_file = acquire_user_lock(user_id)
+    if lock_file is None:
+        # Another process is training this user; keep the job fresh and try again shortly
+        update_training_job(job_id)
+        set_waiting(job_id)
+        retry = threading.Timer(LOCK_RETRY_SECONDS, executor.submit,
+                                (run_training_job, recognizer, job_id, user_id, student_images_dir))
+        retry.daemon = True
+        retry.start()
+        return
+
+    try:
+        train_locked(recognizer, job_id, user_id, student_images_dir)
+    finally:
+        release_user_lock(lock_file)
+
+
+def train_locked(recognizer, job_id, user_id, student_images_dir):
+    """Body of run_training_job, called with the user's training lock held"""
+    progress = {}
+    last_write = [0.0]
+
+    def report(student_id, name, done, total):
+        progress[str(student_id)] = {'name': name, 'done': done, 'total': total}
+        # Finished students are written at once, partial progress at most once per interval
+        now = time.monotonic()
+        if done >= total or now - last_write[0] >= PROGRESS_WRITE_INTERVAL:
+            last_write[0] = now
+            update_training_job(job_id, progress=progress)
+            touch_waiting_jobs()
+
+    update_training_job(job_id, status='running')
+    touch_waiting_jobs()
+    try:
+        success, message = recognizer.train_user_model(user_id, student_images_dir, progress=report)
+        status = 'completed' if success else 'failed'
+    except Exception as e:
+        print(f"[ERROR] Training job {job_id} crashed: {e}")
+        status, message = 'failed', f"Training error: {e}"
+
+    update_training_job(job_id, status=status, message=message, progress=progress)
+    print(f"[OK] Training job {job_id} for User {user_id}: {status}")